@@ -13,6 +13,12 @@ contains the expression and an example to visualize it and help modifying it.
 The config comes after all the imports and each option is described. The order of the config itself is not importent,
 but it is by default in order of file processing.
 
+Several season folders can be processed in one run, and the stages (scan_files, plan_renames, index_episodes,
+build_jobs, execute_jobs) can be imported and used on their own, because nothing runs at import time.
+
+Example:
+    python merge-multi-versions.py "Show/Season 1" "Show/Season 2" --workers 3
+
 ---
 
 License: MIT
@@ -25,15 +31,23 @@ try:
     # pip install colorama
     from colorama import init as colorama_init
     from colorama import Fore, Back, Style
-    colorama_init(autoreset=True)
-    colored_ffmpeg = True
 except ImportError:
-    colored_ffmpeg = False
+    colorama_init = None
+# colorama wraps stdout, so it is only initialized and the commands are only colored when running as script
+colored_ffmpeg = False
 
 import re
 import os
-import sys
+import copy
+import json
+import time
+import argparse
+import shutil
+import threading
+import subprocess
 from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future
 from pprint import pprint
 from typing import Any, Callable, Iterable, Optional
 from typing_extensions import Self
@@ -41,9 +55,10 @@ from typing_extensions import Self
 """################### START OF USER CONFIG ###################"""
 
 # the folder where all the files are, note that the script does not expect nested input files
+# the folders given on the command line are used instead
 # INPUT_FOLDER: Path = Path(r"C:\Users\fabia\Downloads\r")
 # INPUT_FOLDER: Path = Path(r"C:\Users\fabia\Downloads\sp\Staffel 3")
-INPUT_FOLDER: Path = Path(sys.argv[1])
+INPUT_FOLDER: Optional[Path] = None
 
 # this just renames the input files if needed, but it should normalize the series-episode marker, title and language marker
 # https://regex101.com/r/kloyKZ/2
@@ -98,8 +113,8 @@ LANGUAGE_MAP = {
 DEFAULT_AUDIO_LANG = "deu"
 DEFAULT_SUBTITLE_LANG = None
 
-# the folder where all the merged files should be stored in
-OUTPUT_FOLDER = INPUT_FOLDER / "merged"
+# the folder inside the input folder where all the merged files should be stored in
+OUTPUT_FOLDER_NAME = "merged"
 
 # one of the video files of an episode is renamed by this regex to be used as the name of the output file
 # because the output contains all languages, i want to remove the language part that may be present
@@ -111,10 +126,36 @@ OUTPUT_RENAME_PATTERN = {
 
 # should the ffmpeg command be executed or just shown?
 FFMPEG_EXECUTE = True
-# the command or location of the ffmpeg binary
-FFMPEG_BIN = r"ffmpeg -nostdin"
+# the command or location of the ffmpeg binary, without quotes, also if the path contains spaces
+FFMPEG_BIN = r"ffmpeg"
+# options that are passed to ffmpeg before any input
+FFMPEG_GLOBAL_OPTIONS = ["-nostdin"]
 # append the -y option to the ffmpeg command?
 FFMPEG_YES = True
+# how many episodes are muxed at the same time, stream copying is limited by the storage and not by the cpu,
+# so a few parallel jobs are usually faster, but too many make a hdd or network share seek instead of read
+FFMPEG_WORKERS = 1
+# the output of each ffmpeg job is written to a log file named after the episode in this folder inside the output folder
+FFMPEG_LOG_FOLDER_NAME = "logs"
+# skip an episode if its output already exists, is newer than all its inputs and ffprobe finds the planned number of
+# video, audio and subtitle streams in it, so an interrupted run can be continued
+FFMPEG_RESUME = False
+# the command or location of the ffprobe binary without quotes, which is used to check existing outputs
+FFPROBE_BIN = r"ffprobe"
+
+# if the input folder is on a network share, ffmpeg reading several inputs and writing the output over the network at
+# the same time is much slower than sequential copies, so with a local staging folder the inputs of the next episodes
+# are copied one after another into it while the current episode is muxed locally, and each finished output is copied
+# back with one sequential write; None muxes directly on the input folder
+STAGING_FOLDER: Optional[Path] = None
+# the inputs and outputs of all staged episodes together may not use more space than this in the staging folder
+STAGING_BUDGET_GB = 50
+
+# print the throughput, speed and remaining time of all running ffmpeg jobs every this many seconds, or None for never,
+# which also skips probing the duration of each episode with ffprobe
+PROGRESS_INTERVAL_SEC: Optional[float] = 10
+# the final timings and throughput of every episode are written to this json file in the log folder
+SUMMARY_FILE_NAME = "summary.json"
 
 # set this to True, if you are happy with your config
 START_THE_SCRIPT = True
@@ -122,119 +163,6 @@ START_THE_SCRIPT = True
 """################### END OF USER CONFIG ###################"""
 
 
-if not START_THE_SCRIPT:
-    print("you need to read the config before you can execute the script")
-    print("(you probably just forgot to set the very last parameter of the config)")
-    exit()
-
-
-# collect all files from a directory (non-recursive)
-all_files = list([ path for path in INPUT_FOLDER.iterdir() if path.is_file() ])
-pprint(all_files)
-
-
-# rename all files according to the regex pattern
-if FILE_RENAME_PATTERN.get("pattern") is None or FILE_RENAME_PATTERN.get("repl") is None:
-    raise KeyError("check your FILE_RENAME_PATTERN")
-
-renamed_files = []
-for file in all_files[:]:
-    new_file = file.rename(file.parent / re.sub(**FILE_RENAME_PATTERN, string=file.name))
-    renamed_files.append(new_file)
-    print("renamed to", new_file.name)
-
-
-# group all files by episode
-if COMMON_EPISODE_PATTERN is not None:
-    related_episodes = {}
-    for file in renamed_files:
-        if len(common_match := re.findall(COMMON_EPISODE_PATTERN, file.stem)) > 0:
-            related_episodes.update({ common_match[0]: related_episodes.get(common_match[0], []) + [file] })
-else:
-    related_episodes = {"single_episode": renamed_files}
-
-pprint(related_episodes)
-
-
-# group all episode files by language
-# rename languages according to "ISO 639 Set 3" (see: https://en.wikipedia.org/wiki/List_of_ISO_639_language_codes)
-for episode, files in list(related_episodes.items()):
-
-    related_languages = {}
-    for file in files:
-        
-        if COMMON_LANGUAGE_PATTERN is not None:
-            if len(common_match := re.findall(COMMON_LANGUAGE_PATTERN, file.stem)) > 0:
-                lang = LANGUAGE_MAP[common_match[0]]
-                related_languages.update({ lang: related_languages.get(lang, []) + [file] })
-        else:
-            lang = LANGUAGE_MAP[""]
-            related_languages.update({ lang: related_languages.get(lang, []) + [file] })
-
-    related_episodes[episode] = related_languages
-pprint(related_episodes)
-
-
-# group all language files by file type
-supported_filetypes = {
-    "video": {"mp4", "mkv", "webm", "ts"},
-    "audio": {"mp4", "mp3", "m4a", "weba"},
-    "subtitle": {"srt", "vtt"},
-}
-for episode, languages in list(related_episodes.items()):
-
-    related_languages = {}
-    for lang, files in list(languages.items()):
-
-        filetypes = {}
-        for file in files:
-        
-            # sort files by their type
-            suffix = file.suffix.removeprefix(".")
-            if suffix in supported_filetypes["video"]:
-                filetypes["video"] = file
-            elif suffix in supported_filetypes["audio"]:
-                filetypes["audio"] = file
-            elif suffix in supported_filetypes["subtitle"]:
-                filetypes["subtitle"] = file
-        
-        # discard audio if video is present (assuming the video has an audio track) 
-        if filetypes.get("audio") is not None and filetypes.get("video") is not None:
-            filetypes.pop("audio")
-
-        # discard language if no supported filetype found
-        if len(filetypes) > 0:
-            related_languages[lang] = filetypes
-        else:
-            print(f"{episode}:{lang}: no supported filetypes found")
-
-    # discard episode if no supported filetype for any language found
-    if len(related_languages) > 0:
-        related_episodes[episode] = related_languages
-    else:
-        print(f"{episode}: no supported filetypes for any language found")
-
-pprint(related_episodes)
-
-
-# create output folder and handle existing files
-try:
-    OUTPUT_FOLDER.mkdir(exist_ok=False, parents=True)
-except (FileExistsError, OSError):
-    print(f"output folder already exists:", str(OUTPUT_FOLDER))
-    existing_files = [ path for path in OUTPUT_FOLDER.iterdir() if path.is_file() ]
-    print(f"output folder contains {len(existing_files)} files")
-    
-    overwrite_files = input("Continue and risk overwriting files? [y/N] ").lower() == "y"
-    if not overwrite_files:
-        print("exit script")
-        exit()
-    
-    OUTPUT_FOLDER.mkdir(exist_ok=True, parents=True)
-    print("output folder created")
-    
-
-
 class Counters:
     def __init__(self, **counters: int) -> Self:
         self.__counters = counters
@@ -266,19 +194,29 @@ class Counters:
 
 
 class FFmpeg:
-    def __init__(self, *, ffmpeg_bin: str = "ffmpeg", yes: bool = False, colored_echo: bool = False) -> Self:
+    def __init__(self, *, ffmpeg_bin: str = "ffmpeg", global_options: Optional[list[str]] = None, yes: bool = False, colored_echo: bool = False) -> Self:
         self.yes: bool = yes
         self.colored_echo: bool = colored_echo
         self.__ffmpeg_bin: str = ffmpeg_bin
-        self.__inputs: list[str] = []
+        self.__global_options: list[str] = list(global_options or [])
+        # paths are kept as Path and only quoted for the shell command
+        self.__inputs: list[str | Path] = []
         self.__arguments: list[str] = []
-        self.__output: list[str] = []
+        self.__output: list[str | Path] = []
 
     @staticmethod
     def escape_path(path: Path) -> str:
         path = re.sub(r"\\+", "/", str(path))       # basically convert windows path to linux path
         return f'"{path}"'
     
+    @classmethod
+    def shell_arguments(cls, arguments: list[str | Path]) -> list[str]:
+        return [ cls.escape_path(arg) if isinstance(arg, Path) else arg for arg in arguments ]
+    
+    def shell_bin(self) -> str:
+        # a binary path with spaces has to be quoted for the shell
+        return f'"{self.__ffmpeg_bin}"' if re.search(r"\s", self.__ffmpeg_bin) else self.__ffmpeg_bin
+    
     def option(self, key: str, value: Optional[str] = None, *, _type: str = "argument") -> Self:
         match _type:
             case "input":
@@ -295,12 +233,14 @@ class FFmpeg:
         return self
     
     def input(self, file: Path) -> Self:
-        return self.option("i", self.escape_path(file.absolute()), _type="input")
+        self.option("i", _type="input")
+        self.__inputs.append(file.absolute())
+        return self
     
     def output(self, file: Path, options: dict[str, str]) -> Self:
         for key, value in options.items():
             self = self.option(key, value, _type="output")
-        self.__output.append(self.escape_path(file.absolute()))
+        self.__output.append(file.absolute())
         return self
 
     def echo(self) -> str:
@@ -309,99 +249,767 @@ class FFmpeg:
 
         arguments = []
         reset = Fore.RESET + Back.RESET + Style.RESET_ALL
-        arguments.extend([ Style.BRIGHT + self.__ffmpeg_bin + reset])
-        arguments.extend([ Fore.CYAN + arg + reset for arg in self.__inputs ])
+        arguments.extend([ Style.BRIGHT + arg + reset for arg in [self.shell_bin(), *self.__global_options] ])
+        arguments.extend([ Fore.CYAN + arg + reset for arg in self.shell_arguments(self.__inputs) ])
         arguments.extend([ Fore.GREEN + arg + reset for arg in self.__arguments ])
-        arguments.extend([ Fore.RED + arg + reset for arg in self.__output ])
+        arguments.extend([ Fore.RED + arg + reset for arg in self.shell_arguments(self.__output) ])
         if self.yes:
             arguments.extend([ Style.BRIGHT + "-y" + reset])
         return " ".join(arguments)
 
-    def build(self) -> list[str]:
-        arguments = [self.__ffmpeg_bin]
-        arguments.extend(self.__inputs)
+    def relocate(self, paths: dict[Path, Path]) -> Self:
+        # returns a copy of the command with the input and output paths replaced by the mapped ones
+        relocated = copy.copy(self)
+        relocated.__inputs = [ paths.get(arg, arg) if isinstance(arg, Path) else arg for arg in self.__inputs ]
+        relocated.__global_options = list(self.__global_options)
+        relocated.__arguments = list(self.__arguments)
+        relocated.__output = [ paths.get(arg, arg) if isinstance(arg, Path) else arg for arg in self.__output ]
+        return relocated
+
+    def build(self, *, shell: bool = True) -> list[str]:
+        # without a shell, the binary and the paths are passed as they are and must not be quoted
+        if not shell:
+            arguments = [self.__ffmpeg_bin, *self.__global_options]
+            arguments.extend(map(str, self.__inputs))
+            arguments.extend(self.__arguments)
+            arguments.extend(map(str, self.__output))
+            if self.yes:
+                arguments.append("-y")
+            return arguments
+        
+        arguments = [self.shell_bin(), *self.__global_options]
+        arguments.extend(self.shell_arguments(self.__inputs))
         arguments.extend(self.__arguments)
-        arguments.extend(self.__output)
+        arguments.extend(self.shell_arguments(self.__output))
         if self.yes:
             arguments.append("-y")
         return arguments
 
-    def execute(self) -> int:
-        command = self.build()
-        return os.system(" ".join(command))         # subprocess.run refuses to work with ffmpeg on windows
+    def execute(self, log_file: Optional[Path] = None, progress: Optional[Callable[[dict[str, str]], None]] = None) -> int:
+        # the paths are passed unquoted as separate arguments, so no shell is involved on any platform
+        command = self.build(shell=False)
+        if progress is None:
+            if log_file is None:
+                return subprocess.run(command, stdin=subprocess.DEVNULL).returncode
+            with open(log_file, "w", encoding="utf-8", errors="replace") as log:
+                log.write(" ".join(self.build()) + "\n\n")
+                log.flush()
+                return subprocess.run(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT).returncode
+        
+        # ffmpeg writes blocks of key=value lines to stdout, each block ends with progress=continue or progress=end
+        # -progress is a global option, so it has to come before the output file
+        command[1:1] = ["-progress", "pipe:1", "-nostats"]
+        log = open(log_file, "w", encoding="utf-8", errors="replace") if log_file is not None else None
+        try:
+            if log is not None:
+                log.write(" ".join(self.build()) + "\n\n")
+                log.flush()
+            with subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log, text=True, errors="replace") as process:
+                block: dict[str, str] = {}
+                for line in process.stdout:
+                    key, _, value = line.strip().partition("=")
+                    block[key] = value
+                    if key == "progress":
+                        progress(block)
+                        block = {}
+                return process.wait()
+        finally:
+            if log is not None:
+                log.close()
+
+
+@dataclass
+class Config:
+    """
+    the user config with compiled patterns, it is created once and can be reused for many input folders
+    """
+    file_rename_pattern: dict[str, str] = field(default_factory=lambda: dict(FILE_RENAME_PATTERN))
+    episode_pattern: Optional[str] = COMMON_EPISODE_PATTERN
+    language_pattern: Optional[str] = COMMON_LANGUAGE_PATTERN
+    language_map: dict[str, str] = field(default_factory=lambda: dict(LANGUAGE_MAP))
+    default_audio_lang: Optional[str] = DEFAULT_AUDIO_LANG
+    default_subtitle_lang: Optional[str] = DEFAULT_SUBTITLE_LANG
+    output_folder_name: str = OUTPUT_FOLDER_NAME
+    output_rename_pattern: dict[str, str] = field(default_factory=lambda: dict(OUTPUT_RENAME_PATTERN))
+    ffmpeg_execute: bool = FFMPEG_EXECUTE
+    ffmpeg_bin: str = FFMPEG_BIN
+    ffmpeg_global_options: list[str] = field(default_factory=lambda: list(FFMPEG_GLOBAL_OPTIONS))
+    ffmpeg_yes: bool = FFMPEG_YES
+    ffmpeg_workers: int = FFMPEG_WORKERS
+    ffmpeg_log_folder_name: str = FFMPEG_LOG_FOLDER_NAME
+    ffmpeg_resume: bool = FFMPEG_RESUME
+    ffprobe_bin: str = FFPROBE_BIN
+    staging_folder: Optional[Path] = STAGING_FOLDER
+    staging_budget_gb: float = STAGING_BUDGET_GB
+    progress_interval_sec: Optional[float] = PROGRESS_INTERVAL_SEC
+    summary_file_name: str = SUMMARY_FILE_NAME
+    
+    def __post_init__(self) -> None:
+        if self.file_rename_pattern.get("pattern") is None or self.file_rename_pattern.get("repl") is None:
+            raise KeyError("check your FILE_RENAME_PATTERN")
+        if self.output_rename_pattern.get("pattern") is None or self.output_rename_pattern.get("repl") is None:
+            raise KeyError("check your OUTPUT_RENAME_PATTERN")
+        
+        self.file_rename_regex = re.compile(self.file_rename_pattern["pattern"])
+        self.episode_regex = re.compile(self.episode_pattern) if self.episode_pattern is not None else None
+        self.language_regex = re.compile(self.language_pattern) if self.language_pattern is not None else None
+        self.output_rename_regex = re.compile(self.output_rename_pattern["pattern"])
+
+
+@dataclass
+class Job:
+    """
+    the planned ffmpeg command of one episode, which writes to the temporary file and is renamed to the output file
+    """
+    episode: str
+    ffmpeg: FFmpeg
+    output_file: Path
+    inputs: list[Path]
+    counter: Counters
+    
+    @property
+    def temporary_file(self) -> Path:
+        return temporary_file(self.output_file)
+
 
+# ffmpeg writes to this file first, so an interrupted job never leaves a truncated output behind
+# the suffix stays the same, because ffmpeg chooses the container by it
+def temporary_file(output_file: Path) -> Path:
+    return output_file.with_name(f"{output_file.stem}.partial{output_file.suffix}")
+
+
+# collect all files from a directory (non-recursive)
+def scan_files(input_folder: Path) -> list[Path]:
+    return [ path for path in input_folder.iterdir() if path.is_file() ]
+
+
+# plan the renaming of all files according to the regex pattern, without touching them
+def plan_renames(files: Iterable[Path], config: Config) -> list[tuple[Path, Path]]:
+    return [ (file, file.parent / config.file_rename_regex.sub(config.file_rename_pattern["repl"], file.name)) for file in files ]
 
-# build an ffmpeg command for each episode
-if OUTPUT_RENAME_PATTERN.get("pattern") is None or OUTPUT_RENAME_PATTERN.get("repl") is None:
-    raise KeyError("check your OUTPUT_RENAME_PATTERN")
 
-for episode, languages in related_episodes.items():
-    ffmpeg = FFmpeg(yes=FFMPEG_YES, colored_echo=colored_ffmpeg)
-    counter = Counters(video=0, audio=0, subtitle=0)
+def apply_renames(renames: Iterable[tuple[Path, Path]], *, verbose: bool = True) -> list[Path]:
+    renamed_files = []
+    for file, new_file in renames:
+        if file != new_file:
+            file.rename(new_file)
+            if verbose:
+                print("renamed to", new_file.name)
+        renamed_files.append(new_file)
+    return renamed_files
+
+
+# files are grouped by episode, then by language and then by file type
+# the file types are checked in this order, so an mp4 is always a video
+SUPPORTED_FILETYPES = {
+    "video": {"mp4", "mkv", "webm", "ts"},
+    "audio": {"mp4", "mp3", "m4a", "weba"},
+    "subtitle": {"srt", "vtt"},
+}
+
+
+def first_match(pattern: re.Pattern, string: str) -> Optional[str | tuple[str, ...]]:
+    # same result as re.findall(pattern, string)[0], but stops at the first match
+    if (match := pattern.search(string)) is None:
+        return None
+    if pattern.groups == 0:
+        return match.group(0)
+    if pattern.groups == 1:
+        return match.group(1)
+    return match.groups()
+
+
+def index_episodes(
+        files: Iterable[Path],
+        episode_pattern: Optional[str | re.Pattern] = None,
+        language_pattern: Optional[str | re.Pattern] = None,
+        language_map: Optional[dict[str, str]] = None,
+        supported_filetypes: dict[str, set[str]] = SUPPORTED_FILETYPES,
+        *,
+        verbose: bool = True,
+    ) -> dict[str, dict[str, dict[str, Path]]]:
+    """
+    groups the files in one pass into episode -> language -> file type -> file
     
-    # get video track
-    video_track = None
-    for lang, filetypes in languages.items():
-        if (file := filetypes.get("video")) is not None:
-            video_track = file
-            print(f"{episode}: use video track of language {lang}")
-            break
-    if video_track is None:
-        print(f"{episode}: no video file found")
-        break
-
-    ffmpeg = ffmpeg.input(video_track).option("map", f"{counter.total()}:v:0")
-    counter.update_video()
+    files without an episode or language match are ignored, if the pattern is None all files belong to the episode
+    'single_episode' or the language language_map[""], respectively; for several files of the same type the last one
+    is used, an audio file is discarded if the language has a video, and languages and episodes without any supported
+    file are discarded
+    """
+    episode_regex = re.compile(episode_pattern) if isinstance(episode_pattern, str) else episode_pattern
+    language_regex = re.compile(language_pattern) if isinstance(language_pattern, str) else language_pattern
+    language_map = LANGUAGE_MAP if language_map is None else language_map
+    # the first file type of a suffix wins
+    suffix_filetypes = { suffix: filetype for filetype, suffixes in reversed(supported_filetypes.items()) for suffix in suffixes }
     
-    # get audio or audio from video per language
-    for lang, filetypes in languages.items():
+    index: dict[str, dict[str, dict[str, Path]]] = {}
+    for file in files:
+        stem = file.stem
+        
+        if episode_regex is None:
+            episode = "single_episode"
+        elif (episode := first_match(episode_regex, stem)) is None:
+            continue
         
-        if (audio_track := filetypes.get("video", filetypes.get("audio"))) is None:
-            print(f"{episode}:{lang}: no audio track found")
+        languages = index.setdefault(episode, {})
+        if language_regex is None:
+            lang = language_map[""]
+        elif (common_match := first_match(language_regex, stem)) is None:
             continue
-        print(f"{episode}:{lang}: use audio track", str(audio_track))
+        else:
+            lang = language_map[common_match]
+        
+        filetypes = languages.setdefault(lang, {})
+        if (filetype := suffix_filetypes.get(file.suffix.removeprefix("."))) is not None:
+            filetypes[filetype] = file
+    
+    # the groups are few compared to the files, so they are cleaned up afterwards
+    for episode, languages in list(index.items()):
+        for lang, filetypes in list(languages.items()):
+            
+            # discard audio if video is present (assuming the video has an audio track) 
+            if "audio" in filetypes and "video" in filetypes:
+                filetypes.pop("audio")
             
-        ffmpeg = (
-            ffmpeg
-            .input(audio_track)
-            .option("map", f"{counter.total()}:a:0")
-            .option(f"metadata:s:a:{counter.get_audio()}", f"language={lang}")
-            .option(f"disposition:a:{counter.get_audio()}", "+default" if DEFAULT_AUDIO_LANG == lang else "-default")
-        )
-        counter.update_audio()
+            # discard language if no supported filetype found
+            if len(filetypes) == 0:
+                languages.pop(lang)
+                if verbose:
+                    print(f"{episode}:{lang}: no supported filetypes found")
+        
+        # discard episode if no supported filetype for any language found
+        if len(languages) == 0:
+            index.pop(episode)
+            if verbose:
+                print(f"{episode}: no supported filetypes for any language found")
     
-    # get subtitle per language
-    for lang, filetypes in languages.items():
+    return index
+
+
+# build an ffmpeg command for each episode
+def build_jobs(
+        related_episodes: dict[str, dict[str, dict[str, Path]]],
+        output_folder: Path,
+        config: Config,
+        *,
+        verbose: bool = True,
+    ) -> list[Job]:
+    jobs: list[Job] = []
+    for episode, languages in related_episodes.items():
+        ffmpeg = FFmpeg(ffmpeg_bin=config.ffmpeg_bin, global_options=config.ffmpeg_global_options, yes=config.ffmpeg_yes, colored_echo=colored_ffmpeg)
+        counter = Counters(video=0, audio=0, subtitle=0)
+        inputs: list[Path] = []
         
-        if (subtitle_track := filetypes.get("subtitle")) is None:
-            print(f"{episode}:{lang}: no subtitle track found")
+        # get video track
+        video_track = None
+        for lang, filetypes in languages.items():
+            if (file := filetypes.get("video")) is not None:
+                video_track = file
+                if verbose:
+                    print(f"{episode}: use video track of language {lang}")
+                break
+        if video_track is None:
+            print(f"{episode}: no video file found")
             continue
-        print(f"{episode}:{lang}: use subtitle track", str(subtitle_track))
+
+        ffmpeg = ffmpeg.input(video_track).option("map", f"{counter.total()}:v:0")
+        inputs.append(video_track)
+        counter.update_video()
         
-        ffmpeg = (
-            ffmpeg
-            .input(subtitle_track)
-            .option("map", f"{counter.total()}:s:0")
-            .option(f"metadata:s:s:{counter.get_subtitle()}", f"language={lang}")
-            .option(f"disposition:s:{counter.get_subtitle()}", "+default" if DEFAULT_SUBTITLE_LANG == lang else "-default")
-        )
-        counter.update_subtitle()
-    
-    # get output file
-    output_file = OUTPUT_FOLDER / re.sub(**OUTPUT_RENAME_PATTERN, string=video_track.name)
-    output_options = {"c:v": "copy", "c:a": "copy"}
-    if counter.get_subtitle() > 0:
-        output_options["c:s"] = "copy"  # assuming srt or vtt
-        output_file = output_file.with_suffix(".mkv")
+        # get audio or audio from video per language
+        for lang, filetypes in languages.items():
+            
+            if (audio_track := filetypes.get("video", filetypes.get("audio"))) is None:
+                if verbose:
+                    print(f"{episode}:{lang}: no audio track found")
+                continue
+            if verbose:
+                print(f"{episode}:{lang}: use audio track", str(audio_track))
+                
+            ffmpeg = (
+                ffmpeg
+                .input(audio_track)
+                .option("map", f"{counter.total()}:a:0")
+                .option(f"metadata:s:a:{counter.get_audio()}", f"language={lang}")
+                .option(f"disposition:a:{counter.get_audio()}", "+default" if config.default_audio_lang == lang else "-default")
+            )
+            inputs.append(audio_track)
+            counter.update_audio()
         
-    ffmpeg = ffmpeg.output(output_file, output_options)
-    print(f"{episode}: output as", str(output_file))
+        # get subtitle per language
+        for lang, filetypes in languages.items():
+            
+            if (subtitle_track := filetypes.get("subtitle")) is None:
+                if verbose:
+                    print(f"{episode}:{lang}: no subtitle track found")
+                continue
+            if verbose:
+                print(f"{episode}:{lang}: use subtitle track", str(subtitle_track))
+            
+            ffmpeg = (
+                ffmpeg
+                .input(subtitle_track)
+                .option("map", f"{counter.total()}:s:0")
+                .option(f"metadata:s:s:{counter.get_subtitle()}", f"language={lang}")
+                .option(f"disposition:s:{counter.get_subtitle()}", "+default" if config.default_subtitle_lang == lang else "-default")
+            )
+            inputs.append(subtitle_track)
+            counter.update_subtitle()
+        
+        # get output file
+        output_file = output_folder / config.output_rename_regex.sub(config.output_rename_pattern["repl"], video_track.name)
+        output_options = {"c:v": "copy", "c:a": "copy"}
+        if counter.get_subtitle() > 0:
+            output_options["c:s"] = "copy"  # assuming srt or vtt
+            output_file = output_file.with_suffix(".mkv")
+            
+        ffmpeg = ffmpeg.output(temporary_file(output_file), output_options)
+        if verbose:
+            print(f"{episode}: output as", str(output_file))
+            print(f"{episode}:\n", ffmpeg.echo())
+
+        jobs.append(Job(episode, ffmpeg, output_file, inputs, counter))
+    return jobs
+
+
+# create output folder and handle existing files
+# overwrite=None asks on stdin if the folder already exists, which only the command line does
+def prepare_output_folder(output_folder: Path, overwrite: Optional[bool] = False) -> bool:
+    try:
+        output_folder.mkdir(exist_ok=False, parents=True)
+        return True
+    except (FileExistsError, OSError):
+        print(f"output folder already exists:", str(output_folder))
+        existing_files = [ path for path in output_folder.iterdir() if path.is_file() ]
+        print(f"output folder contains {len(existing_files)} files")
+    
+    if overwrite is None:
+        overwrite = input("Continue and risk overwriting files? [y/N] ").lower() == "y"
+    return overwrite
+
+
+# count the streams of a media file by their type with ffprobe
+def probe_stream_counts(file: Path, ffprobe_bin: str = "ffprobe") -> dict[str, int]:
+    command = [ffprobe_bin, "-v", "error", "-show_entries", "stream=codec_type", "-of", "csv=p=0", str(file)]
+    process = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True)
+    
+    stream_counts = {"video": 0, "audio": 0, "subtitle": 0}
+    for codec_type in process.stdout.split():
+        if codec_type in stream_counts:
+            stream_counts[codec_type] += 1
+    return stream_counts
+
+
+# check if the output of a previous run can be kept, returns the reason why not or None
+def check_output(job: Job, ffprobe_bin: str = "ffprobe") -> Optional[str]:
+    try:
+        output_mtime = job.output_file.stat().st_mtime
+    except FileNotFoundError:
+        return "no output"
+    if any( output_mtime <= file.stat().st_mtime for file in job.inputs ):
+        return "output older than an input"
+    
+    try:
+        stream_counts = probe_stream_counts(job.output_file, ffprobe_bin)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        return f"ffprobe failed: {exc}"
+    planned_counts = {"video": job.counter.get_video(), "audio": job.counter.get_audio(), "subtitle": job.counter.get_subtitle()}
+    if stream_counts != planned_counts:
+        return f"streams {stream_counts} instead of {planned_counts}"
+    return None
+
+
+# get the duration in seconds of a media file with ffprobe, or None if it is unknown
+def probe_duration(file: Path, ffprobe_bin: str = "ffprobe") -> Optional[float]:
+    command = [ffprobe_bin, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(file)]
+    try:
+        process = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True)
+        return float(process.stdout.strip())
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+class Progress:
+    """
+    collects the -progress output of all running ffmpeg jobs and prints their throughput in a fixed interval
+    """
+    def __init__(self, total_jobs: int, interval_sec: Optional[float] = None) -> Self:
+        self.total_jobs: int = total_jobs
+        self.interval_sec: Optional[float] = interval_sec
+        self.__lock = threading.Lock()
+        self.__running: dict[str, dict[str, Any]] = {}
+        self.__finished_jobs: int = 0
+        self.__stop = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> Self:
+        if self.interval_sec is not None:
+            self.__thread = threading.Thread(target=self.__report_periodically, daemon=True)
+            self.__thread.start()
+        return self
 
-    # execute ffmpeg
-    print(f"{episode}:\n", ffmpeg.echo())
+    def __exit__(self, *args: Any) -> None:
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def start(self, episode: str, duration_sec: Optional[float]) -> None:
+        with self.__lock:
+            self.__running[episode] = {"started": time.perf_counter(), "duration_sec": duration_sec, "out_time_sec": 0.0, "bytes": 0, "speed": None}
+
+    def update(self, episode: str, block: dict[str, str]) -> None:
+        # out_time_ms is in microseconds as well, it is only named wrong by ffmpeg
+        out_time_us = block.get("out_time_us", block.get("out_time_ms", ""))
+        speed = block.get("speed", "").strip().removesuffix("x")
+        with self.__lock:
+            state = self.__running[episode]
+            if out_time_us.isdigit():
+                state["out_time_sec"] = int(out_time_us) / 1_000_000
+            if block.get("total_size", "").isdigit():
+                state["bytes"] = int(block["total_size"])
+            try:
+                state["speed"] = float(speed)
+            except ValueError:
+                pass
+
+    def finish(self, episode: str) -> dict[str, Any]:
+        # returns the final statistics of the job
+        with self.__lock:
+            state = self.__running.pop(episode)
+            self.__finished_jobs += 1
+        seconds = time.perf_counter() - state["started"]
+        return {
+            "bytes_written": state["bytes"],
+            "media_sec": state["out_time_sec"],
+            "duration_sec": state["duration_sec"],
+            "speed": state["speed"],
+            "mb_per_sec": state["bytes"] / 1024**2 / seconds if seconds > 0 else None,
+        }
 
-    if FFMPEG_EXECUTE:
-        ffmpeg.execute()
+    @staticmethod
+    def format_job(episode: str, state: dict[str, Any], now: float) -> str:
+        elapsed_sec = max(now - state["started"], 1e-9)
+        text = f"{episode} {state['bytes'] / 1024**2 / elapsed_sec:.1f}MB/s"
+        if state["speed"] is not None:
+            text += f" {state['speed']:.1f}x"
+        if state["duration_sec"] and state["out_time_sec"]:
+            percent = min(100, 100 * state["out_time_sec"] / state["duration_sec"])
+            eta_sec = elapsed_sec / state["out_time_sec"] * max(0, state["duration_sec"] - state["out_time_sec"])
+            text += f" {percent:.0f}% eta {int(eta_sec) // 60}:{int(eta_sec) % 60:02d}"
+        return text
+
+    def report(self) -> str:
+        now = time.perf_counter()
+        with self.__lock:
+            running = dict(self.__running)
+            finished_jobs = self.__finished_jobs
+        total_mb_per_sec = sum( state["bytes"] / 1024**2 / max(now - state["started"], 1e-9) for state in running.values() )
+        jobs = ", ".join( self.format_job(episode, state, now) for episode, state in running.items() )
+        return f"progress: {finished_jobs}/{self.total_jobs} done, {len(running)} running at {total_mb_per_sec:.1f}MB/s" + (f" ({jobs})" if jobs else "")
+
+    def __report_periodically(self) -> None:
+        while not self.__stop.wait(self.interval_sec):
+            print(self.report())
+
+
+class Staging:
+    """
+    copies the inputs of the jobs one after another into a local scratch folder ahead of their muxing, as long as the
+    inputs and outputs of all staged jobs fit into the budget, and copies the finished outputs back one at a time
+    """
+    def __init__(self, folder: Path, budget_bytes: int) -> Self:
+        self.folder: Path = folder
+        self.budget_bytes: int = budget_bytes
+        self.__reserved_bytes: int = 0
+        self.__condition = threading.Condition()
+        self.__write_lock = threading.Lock()
+        self.__staged: dict[int, Future] = {}
+        self.__executor: Optional[ThreadPoolExecutor] = None
+
+    def prefetch(self, jobs: list[Job]) -> None:
+        # one copy at a time, so the network share is read sequentially
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        for index, job in enumerate(jobs):
+            self.__staged[id(job)] = self.__executor.submit(self.__stage_in, job, self.folder / f"{index:04d}")
+
+    def close(self) -> None:
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+
+    def __reserve(self, size: int) -> None:
+        with self.__condition:
+            # a single job larger than the budget runs alone instead of never
+            if size > self.budget_bytes:
+                print(f"staging needs {size / 1024**3:.1f}GB, which exceeds the budget of {self.budget_bytes / 1024**3:.1f}GB")
+            self.__condition.wait_for(lambda: self.__reserved_bytes == 0 or self.__reserved_bytes + size <= self.budget_bytes)
+            self.__reserved_bytes += size
+
+    def __release(self, size: int) -> None:
+        with self.__condition:
+            self.__reserved_bytes -= size
+            self.__condition.notify_all()
+
+    def __stage_in(self, job: Job, stage_folder: Path) -> tuple[Job, int]:
+        # the same file can be the video and an audio input
+        inputs = list(dict.fromkeys( file.absolute() for file in job.inputs ))
+        # stream copying writes about as much as it reads
+        reserved = 2 * sum( file.stat().st_size for file in inputs )
+        self.__reserve(reserved)
+        try:
+            stage_folder.mkdir(exist_ok=True)
+            paths = { file: stage_folder / f"{index}_{file.name}" for index, file in enumerate(inputs) }
+            for file, local_file in paths.items():
+                shutil.copyfile(file, local_file)
+            
+            local_output = stage_folder / job.output_file.name
+            paths[job.temporary_file.absolute()] = temporary_file(local_output)
+            return Job(job.episode, job.ffmpeg.relocate(paths), local_output, list(paths.values())[:len(inputs)], job.counter), reserved
+        except BaseException:
+            shutil.rmtree(stage_folder, ignore_errors=True)
+            self.__release(reserved)
+            raise
+
+    def run(self, job: Job, mux: Callable[[Job], Optional[str]], stats: Optional[dict[str, Any]] = None) -> Optional[str]:
+        # waits until the inputs of the job are staged, muxes the staged job and copies its output back
+        # the seconds waited for the staging and spent copying back are added to the stats
+        start = time.perf_counter()
+        local_job, reserved = self.__staged.pop(id(job)).result()
+        stats = stats if stats is not None else {}
+        stats["stage_wait_sec"] = time.perf_counter() - start
+        try:
+            if (error := mux(local_job)) is not None:
+                return error
+            start = time.perf_counter()
+            with self.__write_lock:
+                shutil.copyfile(local_job.output_file, job.temporary_file)
+                os.replace(job.temporary_file, job.output_file)
+            stats["copy_back_sec"] = time.perf_counter() - start
+            return None
+        finally:
+            shutil.rmtree(local_job.output_file.parent, ignore_errors=True)
+            self.__release(reserved)
+
+
+# runs the ffmpeg command of the job into its temporary file and renames it to the output file, returns the error
+def mux(job: Job, log_file: Path, progress: Optional[Callable[[dict[str, str]], None]] = None) -> Optional[str]:
+    # a temporary file of an interrupted run is never complete
+    job.temporary_file.unlink(missing_ok=True)
+    try:
+        returncode = job.ffmpeg.execute(log_file, progress)
+        if returncode == 0:
+            os.replace(job.temporary_file, job.output_file)
+            return None
+        error = f"ffmpeg exited with code {returncode}"
+    except OSError as exc:
+        error = str(exc)
+    job.temporary_file.unlink(missing_ok=True)
+    return error
+
+
+def run_job(
+        job: Job,
+        log_file: Path,
+        staging: Optional[Staging] = None,
+        progress: Optional[Progress] = None,
+        ffprobe_bin: str = "ffprobe",
+    ) -> dict[str, Any]:
+    start = time.perf_counter()
+    stats: dict[str, Any] = {}
+    
+    def mux_with_progress(job: Job) -> Optional[str]:
+        # without progress reporting, ffprobe and -progress are skipped and the written bytes are taken from the output
+        if progress is None:
+            mux_start = time.perf_counter()
+            error = mux(job, log_file)
+            if error is None:
+                stats["bytes_written"] = job.output_file.stat().st_size
+                stats["mb_per_sec"] = stats["bytes_written"] / 1024**2 / max(time.perf_counter() - mux_start, 1e-9)
+            return error
+        progress.start(job.episode, probe_duration(job.inputs[0], ffprobe_bin))
+        try:
+            return mux(job, log_file, lambda block: progress.update(job.episode, block))
+        finally:
+            stats.update(progress.finish(job.episode))
+    
+    try:
+        if staging is None:
+            error = mux_with_progress(job)
+        else:
+            error = staging.run(job, mux_with_progress, stats)
+    except OSError as exc:
+        error = str(exc)
+    
+    result = {"episode": job.episode, "success": error is None, "skipped": False, "error": error, "seconds": time.perf_counter() - start, "output": job.output_file, "log": log_file, **stats}
+    message = f"{job.episode}: {'done' if error is None else 'failed'} after {result['seconds']:.1f}s"
+    if result.get("mb_per_sec") is not None:
+        message += f" at {result['mb_per_sec']:.1f}MB/s"
+    if result.get("speed") is not None:
+        message += f" and {result['speed']:.1f}x speed"
+    print(message)
+    return result
+
+
+# execute all ffmpeg commands in a pool of parallel jobs, the results are in the order of the jobs
+def execute_jobs(
+        jobs: list[Job],
+        log_folder: Path,
+        workers: int = 1,
+        *,
+        resume: bool = False,
+        ffprobe_bin: str = "ffprobe",
+        staging_folder: Optional[Path] = None,
+        staging_budget_bytes: int = 50 * 1024**3,
+        progress_interval_sec: Optional[float] = None,
+    ) -> list[dict[str, Any]]:
+    log_folder.mkdir(exist_ok=True, parents=True)
+    workers = max(1, workers)
+    results: dict[int, dict[str, Any]] = {}
+    
+    # check existing outputs first, so up to date episodes are never staged
+    pending_jobs = jobs
+    if resume:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            reasons = list(executor.map(lambda job: check_output(job, ffprobe_bin), jobs))
+        pending_jobs = []
+        for job, reason in zip(jobs, reasons):
+            if reason is None:
+                print(f"{job.episode}: output is up to date")
+                results[id(job)] = {"episode": job.episode, "success": True, "skipped": True, "error": None, "seconds": 0.0, "output": job.output_file, "log": None}
+            else:
+                print(f"{job.episode}: mux again, {reason}")
+                pending_jobs.append(job)
+    
+    staging = Staging(staging_folder, staging_budget_bytes) if staging_folder is not None else None
+    try:
+        if staging is not None:
+            staging.prefetch(pending_jobs)
+        with Progress(len(pending_jobs), progress_interval_sec) as job_progress, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = { id(job): executor.submit(run_job, job, log_folder / f"{job.episode}.log", staging, job_progress if progress_interval_sec is not None else None, ffprobe_bin) for job in pending_jobs }
+            results.update({ key: future.result() for key, future in futures.items() })
+    finally:
+        if staging is not None:
+            staging.close()
+    
+    return [ results[id(job)] for job in jobs ]
+
+
+def print_summary(results: list[dict[str, Any]]) -> None:
+    for result in results:
+        if result["skipped"]:
+            status = "skipped, up to date"
+        else:
+            status = "ok" if result["success"] else f"FAILED ({result['error']}, see {result['log']})"
+        throughput = f" at {result['mb_per_sec']:.1f}MB/s" if result.get("mb_per_sec") is not None else ""
+        print(f"{result['episode']}: {status} in {result['seconds']:.1f}s{throughput}")
+    if failed := [ result for result in results if not result["success"] ]:
+        print(f"{len(failed)} of {len(results)} episodes failed")
+
+
+def process_folder(
+        input_folder: Path,
+        config: Config,
+        *,
+        overwrite: Optional[bool] = False,
+        verbose: bool = True,
+    ) -> list[dict[str, Any]]:
+    """
+    runs all stages for one folder and returns the result of each executed episode
+    
+    an existing output folder is skipped unless overwrite is True, only overwrite=None asks on stdin
+    """
+    files = scan_files(input_folder)
+    if verbose:
+        pprint(files)
+    
+    # a dry run only shows the planned renames and commands and does not touch the filesystem
+    renames = plan_renames(files, config)
+    if config.ffmpeg_execute:
+        renamed_files = apply_renames(renames, verbose=verbose)
     else:
+        for file, new_file in renames:
+            if file != new_file:
+                print("would rename", file.name, "to", new_file.name)
+        renamed_files = [ new_file for _, new_file in renames ]
+    related_episodes = index_episodes(renamed_files, config.episode_regex, config.language_regex, config.language_map, verbose=verbose)
+    if verbose:
+        pprint(related_episodes)
+    
+    output_folder = input_folder / config.output_folder_name
+    jobs = build_jobs(related_episodes, output_folder, config, verbose=verbose)
+    
+    if not config.ffmpeg_execute:
+        if not verbose:
+            for job in jobs:
+                print(f"{job.episode}:\n", job.ffmpeg.echo())
         print("skipped ffmpeg execution, or set FFMPEG_EXECUTE to True")
+        return []
+    # existing outputs are checked one by one when resuming
+    if not prepare_output_folder(output_folder, True if config.ffmpeg_resume else overwrite):
+        print("skipped", str(input_folder))
+        return []
+    
+    start = time.perf_counter()
+    log_folder = output_folder / config.ffmpeg_log_folder_name
+    results = execute_jobs(
+        jobs,
+        log_folder,
+        config.ffmpeg_workers,
+        resume=config.ffmpeg_resume,
+        ffprobe_bin=config.ffprobe_bin,
+        staging_folder=config.staging_folder,
+        staging_budget_bytes=int(config.staging_budget_gb * 1024**3),
+        progress_interval_sec=config.progress_interval_sec,
+    )
+    seconds = time.perf_counter() - start
+    bytes_written = sum( result.get("bytes_written", 0) for result in results )
+    print(f"\nmuxed {len(results)} episodes of {input_folder} with {config.ffmpeg_workers} workers in {seconds:.1f}s at {bytes_written / 1024**2 / seconds:.1f}MB/s")
+    
+    summary = {"input_folder": input_folder, "workers": config.ffmpeg_workers, "staging_folder": config.staging_folder, "seconds": seconds, "bytes_written": bytes_written, "episodes": results}
+    (log_folder / config.summary_file_name).write_text(json.dumps(summary, indent=2, default=str), encoding="utf-8")
+    return results
+
 
+if __name__ == "__main__":
+    if not START_THE_SCRIPT:
+        print("you need to read the config before you can execute the script")
+        print("(you probably just forgot to set the very last parameter of the config)")
+        exit()
+    
+    if colorama_init is not None:
+        colorama_init(autoreset=True)
+        colored_ffmpeg = True
+
+    _parser = argparse.ArgumentParser(description="Combines the video, audio and subtitle files of each episode into a single file without re-encoding.")
+    _parser.add_argument("input_folders", type=Path, nargs="*", default=[INPUT_FOLDER] if INPUT_FOLDER is not None else [], help="folders with the files of one season each (default: INPUT_FOLDER)")
+    _parser.add_argument("--workers", type=int, default=FFMPEG_WORKERS, help="number of episodes muxed at the same time (default: %(default)s)")
+    _parser.add_argument("--dry-run", action="store_true", default=not FFMPEG_EXECUTE, dest="dry_run", help="only show the ffmpeg commands")
+    _parser.add_argument("--resume", action="store_true", default=FFMPEG_RESUME, help="skip episodes whose output is complete and newer than their inputs")
+    _parser.add_argument("--staging-folder", type=Path, default=STAGING_FOLDER, dest="staging_folder", help="local scratch folder to copy the inputs to before muxing (default: mux in place)")
+    _parser.add_argument("--staging-budget-gb", type=float, default=STAGING_BUDGET_GB, dest="staging_budget_gb", help="maximum space used in the staging folder (default: %(default)s)")
+    _parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL_SEC, dest="progress_interval_sec", help="seconds between the progress reports of the running jobs, 0 disables them (default: %(default)s)")
+    _parser.add_argument("--json", type=Path, default=None, help="also write the results of all episodes of all folders to this json file")
+    _parser.add_argument("--yes", action="store_true", default=None, help="continue without asking if an output folder already exists")
+    _args = _parser.parse_args()
+    if not _args.input_folders:
+        _parser.error("no input folder given and INPUT_FOLDER is not set")
+
+    _config = Config(
+        ffmpeg_workers=_args.workers,
+        ffmpeg_execute=not _args.dry_run,
+        ffmpeg_resume=_args.resume,
+        staging_folder=_args.staging_folder,
+        staging_budget_gb=_args.staging_budget_gb,
+        progress_interval_sec=_args.progress_interval_sec or None,
+    )
+    _results = []
+    for _input_folder in _args.input_folders:
+        _results.extend(process_folder(_input_folder, _config, overwrite=_args.yes))
+    
+    # summary per episode in the order of the episodes
+    print()
+    print_summary(_results)
+    if _args.json is not None:
+        _args.json.write_text(json.dumps(_results, indent=2, default=str), encoding="utf-8")
+    if not all( result["success"] for result in _results ):
+        exit(1)
@@ -0,0 +1,397 @@
+"""
+Benchmarks the playbackactivity-compressor.py script against synthetic databases, so regressions and improvements
+can be tracked offline without a real Jellyfin instance.
+
+For every requested scale, a PlaybackActivity and a BaseItems database are generated with realistic distributions:
+few users and items are responsible for most of the playback activity, the activity grows towards the present and
+peaks in the evening, and some play durations exceed the runtime of their item like with the real plugin.
+
+Every phase runs in its own process on a fresh copy of the generated databases and reports its wall time,
+the processed rows per second and its peak resident set size.
+
+The phase cap_playduration measures the baseline path, which looks up the runtime of every item in the jellyfin
+database and updates the capped entries one by one, so its time is the reference for the single statement of
+cap_playduration_attached and not the time of a full run.
+
+Example:
+    python playbackactivity-compressor-benchmark.py --rows 10000 100000 1000000 --json results.json
+
+---
+
+License: MIT
+Author: Fabian Bartl
+Repository: https://github.com/FabianBartl/jellyfin-scripts
+Last update: 2026-10-18
+"""
+
+import json
+import time
+import random
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+import importlib.util
+import multiprocessing as mp
+import datetime as dt
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Iterator
+
+
+LOG = logging.getLogger(Path(__file__).stem)
+
+COMPRESSOR_PATH = Path(__file__).with_name("playbackactivity-compressor.py")
+
+# the config of the compressor that is used for each phase starting with 'main'
+MAIN_PHASES: dict[str, dict[str, Any]] = {
+    "main": {},
+    "main:cap_via_attach": {"cap_via_attach": True},
+    "main:rollup": {"cap_via_attach": True, "rollup": True},
+    "main:streaming": {"streaming": True},
+    "main:online": {"cap_via_attach": True, "online": True},
+}
+PHASES = ["cap_playduration", "cap_playduration_attached", "compress_activity_range", *MAIN_PHASES]
+
+PLAYBACK_METHODS = ["DirectPlay", "DirectStream", "Transcode"]
+CLIENT_NAMES = ["Jellyfin Web", "Jellyfin Android", "Jellyfin Media Player", "Kodi", "Infuse", "Swiftfin"]
+GENERATE_BATCH_SIZE = 100_000
+
+
+def load_compressor() -> ModuleType:
+    """
+    loads the compressor script as module, because its filename is no valid module name
+    """
+    spec = importlib.util.spec_from_file_location("playbackactivity_compressor", COMPRESSOR_PATH)
+    compressor = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(compressor)
+    return compressor
+
+
+def zipf_weights(count: int, exponent: float) -> list[float]:
+    """
+    returns cumulative weights of a zipf distribution, so a few ranks get most of the draws
+    """
+    cum_weights: list[float] = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1 / rank**exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+def generate_jellyfin_db(
+        jf_db: Path,
+        items: int,
+        rng: random.Random,
+    ) -> list[tuple[str, str, str, int]]:
+    """
+    creates a BaseItems table with episodes and movies and returns (ItemId, ItemType, ItemName, RunTimeSec) per item
+    """
+    base_items: list[tuple[str, str, str, int]] = []
+    for idx in range(items):
+        if rng.random() < 0.8:
+            base_items.append((f"{rng.getrandbits(128):032x}", "Episode", f"Series {idx // 24} - Episode {idx % 24 + 1}", rng.randint(20, 60) * 60))
+        else:
+            base_items.append((f"{rng.getrandbits(128):032x}", "Movie", f"Movie {idx}", rng.randint(80, 180) * 60))
+
+    jf_db_conn = sqlite3.connect(jf_db)
+    jf_db_conn.execute("DROP TABLE IF EXISTS BaseItems")
+    jf_db_conn.execute("""
+        CREATE TABLE BaseItems (
+            Id                    TEXT PRIMARY KEY,
+            PresentationUniqueKey TEXT,
+            Type                  TEXT,
+            Name                  TEXT,
+            RunTimeTicks          INTEGER
+        )
+    """)
+    jf_db_conn.executemany("""
+        INSERT INTO BaseItems
+        VALUES (?, ?, ?, ?, ?)
+    """, [ (item_id, item_id, item_type, item_name, runtime_sec * 10_000_000) for item_id, item_type, item_name, runtime_sec in base_items ])
+    jf_db_conn.execute("CREATE INDEX idx_BaseItems_PresentationUniqueKey ON BaseItems (PresentationUniqueKey)")
+    jf_db_conn.commit()
+    jf_db_conn.close()
+
+    return base_items
+
+
+def generate_activities(
+        rows: int,
+        users: list[str],
+        base_items: list[tuple[str, str, str, int]],
+        years: float,
+        rng: random.Random,
+    ) -> Iterator[tuple]:
+    """
+    yields rows for the PlaybackActivity table in insertion order of the plugin
+    """
+    user_cum_weights = zipf_weights(len(users), 0.8)
+    item_cum_weights = zipf_weights(len(base_items), 1.1)
+    # more activity in the evening than at night
+    hour_weights = [1, 1, 1, 1, 1, 1, 2, 3, 3, 3, 3, 4, 5, 5, 5, 6, 7, 9, 12, 14, 14, 12, 8, 4]
+
+    now = dt.datetime.now().replace(microsecond=0)
+    history_days = int(years * 365)
+
+    for _ in range(rows):
+        # the density grows linearly towards the present
+        day = now - dt.timedelta(days=int(history_days * (1 - rng.random()**0.5)))
+        date_created = day.replace(hour=rng.choices(range(24), hour_weights)[0], minute=rng.randrange(60), second=rng.randrange(60))
+        if date_created > now:
+            date_created = now
+
+        item_id, item_type, item_name, runtime_sec = rng.choices(base_items, cum_weights=item_cum_weights)[0]
+        if rng.random() < 0.05:
+            play_duration = int(runtime_sec * rng.uniform(1.0, 3.0))
+        else:
+            play_duration = int(runtime_sec * rng.betavariate(2, 0.7))
+
+        yield (
+            date_created.strftime("%Y-%m-%d %H:%M:%S.") + f"{rng.randrange(10_000_000):07d}",
+            rng.choices(users, cum_weights=user_cum_weights)[0],
+            item_id,
+            item_type,
+            item_name,
+            rng.choice(PLAYBACK_METHODS),
+            rng.choice(CLIENT_NAMES),
+            f"Device {rng.randrange(20)}",
+            play_duration,
+        )
+
+
+def generate_playback_db(
+        pb_db: Path,
+        rows: int,
+        users: int,
+        base_items: list[tuple[str, str, str, int]],
+        years: float,
+        rng: random.Random,
+    ) -> None:
+    """
+    creates a PlaybackActivity table with the schema of the playback reporting plugin and fills it in batches
+    """
+    pb_db_conn = sqlite3.connect(pb_db)
+    pb_db_conn.execute("DROP TABLE IF EXISTS PlaybackActivity")
+    pb_db_conn.execute("""
+        CREATE TABLE PlaybackActivity (
+            DateCreated    DATETIME NOT NULL,
+            UserId         TEXT,
+            ItemId         TEXT,
+            ItemType       TEXT,
+            ItemName       TEXT,
+            PlaybackMethod TEXT,
+            ClientName     TEXT,
+            DeviceName     TEXT,
+            PlayDuration   INT
+        )
+    """)
+
+    user_ids = [ f"{rng.getrandbits(128):032x}" for _ in range(users) ]
+    activities = generate_activities(rows, user_ids, base_items, years, rng)
+    for batch_start in range(0, rows, GENERATE_BATCH_SIZE):
+        pb_db_conn.executemany("""
+            INSERT INTO PlaybackActivity
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [ next(activities) for _ in range(min(GENERATE_BATCH_SIZE, rows - batch_start)) ])
+        pb_db_conn.commit()
+        LOG.debug("generated %s/%s playback activities", min(batch_start + GENERATE_BATCH_SIZE, rows), rows)
+
+    pb_db_conn.close()
+
+
+def generate_databases(
+        pb_db: Path,
+        jf_db: Path,
+        rows: int,
+        users: int,
+        items: int,
+        years: float,
+        seed: int,
+    ) -> None:
+    """
+    generates both synthetic databases for one scale
+    """
+    rng = random.Random(seed)
+    base_items = generate_jellyfin_db(jf_db, items, rng)
+    generate_playback_db(pb_db, rows, users, base_items, years, rng)
+
+
+def run_in_process(target: Callable, *args: Any) -> None:
+    """
+    runs the target in a freshly spawned process and waits for it
+
+    the benchmark itself never holds large data, because the peak resident set size of a unix process includes the one
+    of its parent at the time it was spawned
+    """
+    process = mp.get_context("spawn").Process(target=target, args=args)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{target.__name__}{args} failed with exit code {process.exitcode}")
+
+
+def run_phase(
+        phase: str,
+        pb_db: Path,
+        jf_db: Path,
+        log_level: int,
+        results: mp.Queue,
+    ) -> None:
+    """
+    runs one phase of the compressor in the current process and puts its measurements into the results queue
+    """
+    compressor = load_compressor()
+    compressor.LOG.setLevel(log_level)
+
+    pb_db_conn = sqlite3.connect(pb_db, uri=True)
+    pb_db_conn.row_factory = sqlite3.Row
+    pb_db_cur = pb_db_conn.cursor()
+    rows = pb_db_cur.execute("SELECT COUNT(*) FROM PlaybackActivity").fetchone()[0]
+
+    start = time.perf_counter()
+
+    if phase == "cap_playduration":
+        jf_db_conn = sqlite3.connect(jf_db)
+        jf_db_conn.row_factory = sqlite3.Row
+        compressor.cap_playduration(pb_db_cur, jf_db_conn.cursor())
+        pb_db_conn.commit()
+        jf_db_conn.close()
+
+    elif phase == "cap_playduration_attached":
+        compressor.attach_jellyfin_db(pb_db_cur, jf_db)
+        compressor.cap_playduration_attached(pb_db_cur)
+        pb_db_conn.commit()
+
+    elif phase == "compress_activity_range":
+        compressor.ensure_datecreated_index(pb_db_cur)
+        pb_db_conn.commit()
+        buckets, _ = compressor.get_activity_buckets(pb_db_cur, compressor.Retention())
+        for _from, to, _ in buckets:
+            compressor.compress_activity_range(pb_db_cur, _from, to)
+            pb_db_conn.commit()
+
+    elif phase in MAIN_PHASES:
+        pb_db_conn.close()
+        compressor.CONFIG = compressor.Config(playback_activity_db=pb_db, jellyfin_db=jf_db, **MAIN_PHASES[phase])
+        compressor.main()
+
+    else:
+        raise ValueError(f"unknown phase '{phase}'")
+
+    wall_sec = time.perf_counter() - start
+    pb_db_conn.close()
+
+    results.put({
+        "phase": phase,
+        "rows": rows,
+        "wall_sec": wall_sec,
+        "rows_per_sec": rows / wall_sec if wall_sec > 0 else None,
+        "peak_rss_bytes": compressor.get_peak_rss(),
+    })
+
+
+def benchmark_phase(
+        phase: str,
+        pb_db: Path,
+        jf_db: Path,
+        work_dir: Path,
+        log_level: int,
+    ) -> dict[str, Any]:
+    """
+    runs one phase in a fresh process on a copy of the playback database, so the peak memory belongs to this phase only
+    """
+    pb_db_copy = work_dir / f"playback_reporting.{phase.replace(':', '_')}.db"
+    shutil.copyfile(pb_db, pb_db_copy)
+
+    results = mp.get_context("spawn").Queue()
+    run_in_process(run_phase, phase, pb_db_copy, jf_db, log_level, results)
+    result = results.get()
+    result["db_bytes_before"] = pb_db.stat().st_size
+    result["db_bytes_after"] = pb_db_copy.stat().st_size
+    pb_db_copy.unlink()
+    return result
+
+
+def print_results(results: list[dict[str, Any]]) -> None:
+    """
+    prints the measurements of all scales and phases as aligned table
+    """
+    header = f"{'scale':>10}  {'phase':<26}  {'wall':>9}  {'rows/s':>12}  {'peak rss':>10}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        peak_rss = f"{result['peak_rss_bytes'] / 1024**2:.1f}MiB" if result["peak_rss_bytes"] is not None else "n/a"
+        rows_per_sec = f"{result['rows_per_sec']:.0f}" if result["rows_per_sec"] is not None else "n/a"
+        print(f"{result['scale']:>10}  {result['phase']:<26}  {result['wall_sec']:>8.2f}s  {rows_per_sec:>12}  {peak_rss:>10}")
+    if any( result["phase"] == "cap_playduration" for result in results ):
+        print("\ncap_playduration is the baseline with one UPDATE per capped entry, compare it with cap_playduration_attached")
+
+
+def main(
+        scales: list[int],
+        phases: list[str],
+        *,
+        users: int = 8,
+        items: int = 5_000,
+        years: float = 3,
+        seed: int = 0,
+        work_dir: Path = None,
+        log_level: int = logging.WARNING,
+    ) -> list[dict[str, Any]]:
+    """
+    generates the synthetic databases for every scale and benchmarks all phases on them
+    """
+    global LOG
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        pb_db = tmp_dir / "playback_reporting.db"
+        jf_db = tmp_dir / "jellyfin.db"
+
+        results: list[dict[str, Any]] = []
+        for scale in scales:
+            start = time.perf_counter()
+            run_in_process(generate_databases, pb_db, jf_db, scale, users, items, years, seed)
+            LOG.info("generated %s playback activities of %s users and %s items in %.1fs", scale, users, items, time.perf_counter() - start)
+
+            for phase in phases:
+                result = benchmark_phase(phase, pb_db, jf_db, tmp_dir, log_level)
+                result["scale"] = scale
+                results.append(result)
+                LOG.info("%s with %s rows took %.2fs", phase, scale, result["wall_sec"])
+
+    return results
+
+
+if __name__ == "__main__":
+    _parser = argparse.ArgumentParser(description="Benchmarks playbackactivity-compressor.py against synthetic playback activity databases.")
+    _parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000], help="number of playback activities per scale (default: %(default)s)")
+    _parser.add_argument("--phases", choices=PHASES, nargs="+", default=PHASES, help="phases to benchmark (default: all)")
+    _parser.add_argument("--users", type=int, default=8, help="number of users (default: %(default)s)")
+    _parser.add_argument("--items", type=int, default=5_000, help="number of base items (default: %(default)s)")
+    _parser.add_argument("--years", type=float, default=3, help="years of playback history (default: %(default)s)")
+    _parser.add_argument("--seed", type=int, default=0, help="seed of the random generator (default: %(default)s)")
+    _parser.add_argument("--work-dir", type=Path, default=None, dest="work_dir", help="directory for the temporary databases (default: system temp)")
+    _parser.add_argument("--json", type=Path, default=None, help="also write the results to this json file")
+    _parser.add_argument("--verbose", action="store_true", default=False, help="show the log output of the compressor")
+    _args = _parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    results = main(
+        _args.rows,
+        _args.phases,
+        users=_args.users,
+        items=_args.items,
+        years=_args.years,
+        seed=_args.seed,
+        work_dir=_args.work_dir,
+        log_level=logging.DEBUG if _args.verbose else logging.WARNING,
+    )
+    print_results(results)
+
+    if _args.json is not None:
+        _args.json.write_text(json.dumps(results, indent=2), encoding="utf-8")
@@ -0,0 +1,213 @@
+"""
+Runs playbackactivity-compressor.py for several Jellyfin servers concurrently, so the nightly maintenance takes as long
+as the slowest server instead of all servers one after another.
+
+The targets are read from a json file. Every target needs the paths of its playback reporting and jellyfin databases
+and can override the retention and any other option of the compressor config. The options under "defaults" apply to
+all targets:
+
+    {
+        "workers": 2,
+        "defaults": {"cap_via_attach": true, "incremental": true, "vacuum": "incremental"},
+        "targets": [
+            {
+                "name": "living-room",
+                "playback_activity_db": "/srv/jellyfin-a/data/playback_reporting.db",
+                "jellyfin_db": "/srv/jellyfin-a/data/jellyfin.db"
+            },
+            {
+                "name": "family",
+                "playback_activity_db": "/srv/jellyfin-b/data/playback_reporting.db",
+                "jellyfin_db": "/srv/jellyfin-b/data/jellyfin.db",
+                "retention": {"years": -1, "months": 12, "weeks": 4, "days": 14, "hours": 48}
+            }
+        ]
+    }
+
+Every target runs in its own process of the pool with its own compressor instance. A failing target does not stop
+the others. At the end one summary with the capped and compressed rows, the time and the reclaimed bytes per target
+is printed.
+
+Example:
+    python playbackactivity-compressor-multi.py servers.json --workers 4 --json summary.json
+
+---
+
+License: MIT
+Author: Fabian Bartl
+Repository: https://github.com/FabianBartl/jellyfin-scripts
+Last update: 2026-10-18
+"""
+
+import json
+import time
+import logging
+import argparse
+import traceback
+import importlib.util
+import multiprocessing as mp
+from pathlib import Path
+from types import ModuleType
+from typing import Any
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+LOG = logging.getLogger(Path(__file__).stem)
+
+COMPRESSOR_PATH = Path(__file__).with_name("playbackactivity-compressor.py")
+
+# options of the compressor config that are paths
+PATH_OPTIONS = ["playback_activity_db", "jellyfin_db", "archive_dir", "metrics_file"]
+
+
+def load_compressor() -> ModuleType:
+    """
+    loads the compressor script as module, because its filename is no valid module name
+
+    every call returns a new module, so the global config and metrics of different targets never mix
+    """
+    spec = importlib.util.spec_from_file_location("playbackactivity_compressor", COMPRESSOR_PATH)
+    compressor = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(compressor)
+    return compressor
+
+
+def load_targets(config_file: Path) -> tuple[list[dict[str, Any]], int]:
+    """
+    reads the targets with the defaults applied and the worker count from the json config file
+    """
+    config = json.loads(config_file.read_text(encoding="utf-8"))
+    defaults = config.get("defaults", {})
+
+    targets: list[dict[str, Any]] = []
+    for index, target in enumerate(config["targets"]):
+        options = {**defaults, **target}
+        options.setdefault("name", Path(options["playback_activity_db"]).parent.name or f"target-{index}")
+        targets.append(options)
+
+    if not targets:
+        raise ValueError(f"no targets in {config_file}")
+
+    # two processes compressing the same database would only block each other
+    names = [ target["name"] for target in targets ]
+    if len(set(names)) != len(names):
+        raise ValueError(f"target names must be unique: {names}")
+    playback_dbs = [ Path(target["playback_activity_db"]).resolve() for target in targets ]
+    if len(set(playback_dbs)) != len(playback_dbs):
+        raise ValueError("every target needs its own playback activity database")
+
+    return targets, config.get("workers", mp.cpu_count())
+
+
+def compress_target(options: dict[str, Any], log_level: int) -> dict[str, Any]:
+    """
+    runs the compressor for one target and returns its summary
+
+    runs in a worker process, so the log lines are prefixed with the target name
+    """
+    options = dict(options)
+    name = options.pop("name")
+    # the worker processes are reused for several targets, so the handler of the previous target has to be replaced
+    logging.basicConfig(level=log_level, format=f"%(asctime)s [{name}] %(levelname)s: %(message)s", force=True)
+
+    summary: dict[str, Any] = {"name": name, "status": "ok", "error": None}
+    start = time.perf_counter()
+    try:
+        compressor = load_compressor()
+        for key in PATH_OPTIONS:
+            if options.get(key) is not None:
+                options[key] = Path(options[key])
+        retention = compressor.Retention(**options.pop("retention", {}))
+        compressor.CONFIG = compressor.Config(retention=retention, **options)
+
+        summary["bytes_before"] = compressor.get_db_size(compressor.CONFIG.playback_activity_db)
+        compressor.main()
+        summary["bytes_after"] = compressor.get_db_size(compressor.CONFIG.playback_activity_db)
+
+        # without vacuum the file does not shrink and may even grow by the new index, so nothing is reclaimed
+        counters = compressor.METRICS.counters
+        summary["bytes_reclaimed"] = counters.get("bytes_reclaimed") if compressor.CONFIG.vacuum is not None else None
+        summary["rows_capped"] = counters.get("rows_capped", 0)
+        summary["rows_compressed"] = counters.get("rows_deleted", 0) - counters.get("rows_inserted", 0)
+        summary["buckets_rewritten"] = counters.get("buckets_rewritten", 0)
+
+    except Exception as error:
+        summary["status"] = "failed"
+        summary["error"] = f"{type(error).__name__}: {error}"
+        logging.getLogger(name).error("compression failed:\n%s", traceback.format_exc())
+
+    summary["wall_sec"] = time.perf_counter() - start
+    return summary
+
+
+def print_summary(summaries: list[dict[str, Any]], wall_sec: float) -> None:
+    """
+    prints the summaries of all targets and their totals as aligned table
+    """
+    header = f"{'target':<20}  {'status':<6}  {'wall':>9}  {'rows capped':>12}  {'rows compressed':>15}  {'reclaimed':>11}"
+    print(header)
+    print("-" * len(header))
+    for summary in summaries:
+        reclaimed = f"{summary['bytes_reclaimed'] / 1024**2:.1f}MiB" if summary.get("bytes_reclaimed") is not None else "n/a"
+        print(f"{summary['name']:<20}  {summary['status']:<6}  {summary['wall_sec']:>8.2f}s  {summary.get('rows_capped', 0):>12}  {summary.get('rows_compressed', 0):>15}  {reclaimed:>11}")
+    print("-" * len(header))
+
+    reclaimed = sum( summary.get("bytes_reclaimed") or 0 for summary in summaries )
+    print(f"{'total':<20}  {'':<6}  {wall_sec:>8.2f}s  {sum( s.get('rows_capped', 0) for s in summaries ):>12}  {sum( s.get('rows_compressed', 0) for s in summaries ):>15}  {reclaimed / 1024**2:>8.1f}MiB")
+    for summary in summaries:
+        if summary["error"] is not None:
+            print(f"{summary['name']}: {summary['error']}")
+
+
+def main(
+        targets: list[dict[str, Any]],
+        workers: int,
+        log_level: int = logging.INFO,
+    ) -> list[dict[str, Any]]:
+    """
+    compresses all targets in a pool of worker processes and returns their summaries in the order of the targets
+    """
+    global LOG
+
+    if not targets:
+        LOG.info("no targets to compress")
+        return []
+
+    start = time.perf_counter()
+    summaries: dict[str, dict[str, Any]] = {}
+    # spawn instead of fork, so no worker inherits the sqlite connections or memory of another
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(targets))), mp_context=mp.get_context("spawn")) as executor:
+        futures = { executor.submit(compress_target, target, log_level): target["name"] for target in targets }
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries[summary["name"]] = summary
+            LOG.info("%s %s after %.1fs", summary["name"], "finished" if summary["status"] == "ok" else "failed", summary["wall_sec"])
+
+    LOG.info("compressed %s targets with %s workers in %.1fs", len(targets), workers, time.perf_counter() - start)
+    return [ summaries[target["name"]] for target in targets ]
+
+
+if __name__ == "__main__":
+    _parser = argparse.ArgumentParser(description="Runs playbackactivity-compressor.py for several Jellyfin servers concurrently.")
+    _parser.add_argument("config", type=Path, help="json file with the targets and their options")
+    _parser.add_argument("--workers", type=int, default=None, help="number of targets compressed at the same time (default: from config or cpu count)")
+    _parser.add_argument("--json", type=Path, default=None, help="also write the summary to this json file")
+    _parser.add_argument("--verbose", action="store_true", default=False, help="show the debug log output of the compressor")
+    _args = _parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        _targets, _workers = load_targets(_args.config)
+    except ValueError as error:
+        _parser.error(str(error))
+    _start = time.perf_counter()
+    _summaries = main(
+        _targets,
+        _args.workers or _workers,
+        log_level=logging.DEBUG if _args.verbose else logging.INFO,
+    )
+    print_summary(_summaries, time.perf_counter() - _start)
+
+    if _args.json is not None:
+        _args.json.write_text(json.dumps(_summaries, indent=2), encoding="utf-8")
@@ -9,14 +9,37 @@ Repository: https://github.com/FabianBartl/jellyfin-scripts
 Last update: 2026-04-09
 """
 
+import os
+import sys
+import csv
+import gzip
+import time
+import bisect
+import shutil
+import json
+import argparse
 import sqlite3
 import datetime as dt
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Any, Union, Optional, NoReturn, Callable
-from pprint import pprint
+from dataclasses import dataclass, field, asdict
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Any, Union, Optional, NoReturn, Callable, Iterator
+from pprint import pprint, pformat
 import logging
 
+try:
+    # only available on unix
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    # pip install psutil
+    import psutil
+except ImportError:
+    psutil = None
+
 
 logging.basicConfig(
     level = logging.DEBUG,
@@ -36,108 +59,1235 @@ class Retention:
 class Config:
     playback_activity_db: Path = Path(r"C:\Users\fabia\Repositories\jellyfin-scripts\data\playback_reporting - Kopie.db")
     jellyfin_db: Path = Path(r"C:\Users\fabia\Repositories\jellyfin-scripts\data\jellyfin - Kopie.db")
-    retention: Retention = Retention()
+    retention: Retention = field(default_factory=Retention)
+    # compress all retention buckets with one GROUP BY over a temporary bucket table instead of one loop per bucket
+    rollup: bool = False
+    # cap playback durations with one UPDATE ... FROM against the read-only attached jellyfin database
+    cap_via_attach: bool = False
+    # skip retention buckets that are already compressed according to the watermark table in the playback database
+    incremental: bool = False
+    # iterate all large queries in chunks of batch_size rows and write them in batches through a separate cursor
+    streaming: bool = False
+    batch_size: int = 10_000
+    # compress while jellyfin is running: use WAL, cap the play durations in short transactions of batch_size entries
+    # and replace each bucket in short transactions of batch_size user/item groups, which are retried with exponential
+    # backoff if the database is busy; only the first run creates the DateCreated index and seeds the daily totals with
+    # one long transaction each
+    online: bool = False
+    busy_timeout_ms: int = 5_000
+    max_retries: int = 5
+    retry_backoff_sec: float = 0.1
+    # only print the row counts per bucket before and after compression and the estimated bytes reclaimed,
+    # the playback activity database is opened read-only; plan_format is one of: table, json
+    plan: bool = False
+    plan_format: str = "table"
+    # archive the raw activities of every bucket before they are deleted into monthly partitions of this folder,
+    # as zstd compressed parquet files if pyarrow is installed or else as gzip compressed csv files
+    archive_dir: Optional[Path] = None
+    # skip buckets that already contain only one activity per user per item dated at the bucket start
+    skip_compact: bool = True
+    # reclaim the space of the deleted activities after compression, one of: None, into, incremental
+    # 'into' rebuilds the database with VACUUM INTO and swaps the files, so no other process may have it open, it needs
+    # free space for two more copies of the database and falls back to an in place VACUUM on windows,
+    # 'incremental' enables auto_vacuum=INCREMENTAL with a one-time rebuild and afterwards only frees unused pages
+    vacuum: Optional[str] = None
+    # page size in bytes the database is rebuilt with, or None to keep the current one
+    page_size: Optional[int] = None
+    # append the timings, counters and query plans of every run as one json document per line to this file
+    metrics_file: Optional[Path] = None
+    # log only every n-th capped playback entry instead of each one
+    log_sample_every: int = 1_000
+    # maintain the per day totals of every user and every item in side tables, which are updated with the raw activities
+    # in the same transaction that compresses them, so reports keep the daily resolution and do not aggregate the raw table
+    daily_totals: bool = False
 
 CONFIG = Config()
 
+@dataclass
+class Metrics:
+    started_at: str = field(default_factory=lambda: dt.datetime.now().isoformat(timespec="seconds"))
+    # per phase: how often it ran, its total and its longest duration in seconds
+    phases: dict[str, dict[str, float]] = field(default_factory=dict)
+    counters: dict[str, int] = field(default_factory=dict)
+    query_plans: dict[str, list[str]] = field(default_factory=dict)
+    
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+    
+    def record(self, phase: str, elapsed_sec: float) -> None:
+        timing = self.phases.setdefault(phase, {"count": 0, "total_sec": 0.0, "max_sec": 0.0})
+        timing["count"] += 1
+        timing["total_sec"] += elapsed_sec
+        timing["max_sec"] = max(timing["max_sec"], elapsed_sec)
+    
+    def count(self, counter: str, value: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + value
+    
+    def write(self, metrics_file: Path, **extra: Any) -> None:
+        with open(metrics_file, "a", encoding="utf-8") as file:
+            file.write(json.dumps({**asdict(self), **extra}, default=str) + "\n")
+
+METRICS = Metrics()
+
+# DateCreated is stored as text like 'YYYY-MM-DD HH:MM:SS[.fffffff]', so comparing it against bounds in the same
+# format is equivalent to comparing datetime(DateCreated), but keeps the column bare and lets sqlite use the index
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATECREATED_INDEX = "idx_PlaybackActivity_DateCreated_UserId_ItemId"
+WATERMARK_TABLE = "CompressorWatermark"
+DAILY_USER_TABLE = "PlaybackActivityDailyUser"
+DAILY_ITEM_TABLE = "PlaybackActivityDailyItem"
+
+ACTIVITY_COLUMNS = ["DateCreated", "UserId", "ItemId", "ItemType", "ItemName", "PlaybackMethod", "ClientName", "DeviceName", "PlayDuration"]
+
+# compressed activities are inserted without playback method, client and device, everything else is a raw activity
+RAW_ACTIVITY_CONDITION = "NOT (PlaybackMethod IS NULL AND ClientName IS NULL AND DeviceName IS NULL)"
+
+# rough per row overhead of the record header, rowid and cell pointer, plus the DateCreated index entry without its key
+ROW_OVERHEAD_BYTES = 16
+
+# a retention bucket with its range _from <= activity < to and the step type (h, d, w, m, y) of its start
+Bucket = tuple[dt.datetime, dt.datetime, str]
+
+
+def table_or_index_exists(
+        pb_db_cur: sqlite3.Cursor,
+        _type: str,
+        name: str,
+    ) -> bool:
+    """
+    checks if a table or an index with the given name exists in the playback activity database
+    """
+    return bool(pb_db_cur.execute("""
+        SELECT COUNT(*)
+        FROM sqlite_master
+        WHERE type = ?
+        AND name = ?
+    """, (_type, name)).fetchone()[0])
+
+
+def ensure_datecreated_index(pb_db_cur: sqlite3.Cursor) -> None:
+    """
+    creates an index on PlaybackActivity.DateCreated if it does not exist yet,
+    so every retention bucket becomes an index range scan instead of a full table scan
+    
+    the index also covers UserId and ItemId, so checking if a bucket is already compact does not touch the table
+    """
+    global LOG
+    
+    # replaced by the covering index
+    pb_db_cur.execute("DROP INDEX IF EXISTS idx_PlaybackActivity_DateCreated")
+    pb_db_cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {DATECREATED_INDEX}
+        ON PlaybackActivity (DateCreated, UserId, ItemId)
+    """)
+    LOG.info("ensured index %s on PlaybackActivity(DateCreated, UserId, ItemId)", DATECREATED_INDEX)
+
+
+def explain_query_plan(
+        db_cur: sqlite3.Cursor,
+        query: str,
+        parameters: Union[tuple, dict] = (),
+        name: Optional[str] = None,
+    ) -> list[str]:
+    """
+    returns and logs the EXPLAIN QUERY PLAN details of the given query without executing it,
+    and keeps them in the run metrics under the given name
+    """
+    global LOG, METRICS
+    
+    plan = [ row[3] for row in db_cur.execute(f"EXPLAIN QUERY PLAN {query}", parameters).fetchall() ]
+    for detail in plan:
+        LOG.info("query plan: %s", detail)
+    METRICS.query_plans[name or " ".join(query.split())] = plan
+    return plan
+
 
 def cap_playduration(
         pb_db_cur: sqlite3.Cursor,
         jf_db_cur: sqlite3.Cursor,
+        log_sample_every: int = 1_000,
     ) -> int:
     """
     caps every playback entry to the runtime of the played item,
     but skips entries where PlaybackMethod is NULL
     
+    only entries that actually exceed the runtime are updated, each by its rowid, so every capping path leaves the same
+    play durations behind
+    
+    only every log_sample_every-th capped entry is logged, because formatting a message per entry dominates the runtime
+    on large tables
+    
     note: this function does not automatically commits the updated playback durations
     """
-    global LOG
+    global LOG, METRICS
     
-    item_runtime = jf_db_cur.execute("""
-        SELECT PresentationUniqueKey AS ItemId, RunTimeTicks / 10000000 AS RunTimeSec
-        FROM BaseItems
-        WHERE RunTimeTicks is NOT NULL
-    """).fetchall()
-    item_runtime_map = { i["ItemId"]: i["RunTimeSec"] for i in item_runtime }
+    with METRICS.timer("cap.load_runtimes"):
+        item_runtime = jf_db_cur.execute("""
+            SELECT PresentationUniqueKey AS ItemId, RunTimeTicks / 10000000 AS RunTimeSec
+            FROM BaseItems
+            WHERE RunTimeTicks is NOT NULL
+        """).fetchall()
+        item_runtime_map = { i["ItemId"]: i["RunTimeSec"] for i in item_runtime }
     LOG.info("found %s base items with set runtime", len(item_runtime))
     
     capplaydur_items: list[tuple] = []
-    for entry in pb_db_cur.execute("""
-        SELECT ItemId, PlayDuration, PlaybackMethod, ItemType, ClientName
-        FROM PlaybackActivity
-        WHERE PlaybackMethod is not NULL
-    """).fetchall():
-        if (runtime_sec := item_runtime_map.get(entry["ItemId"])) != None:
-            if entry["PlayDuration"] > runtime_sec:
-                capplaydur_items.append((runtime_sec, entry["ItemId"]))
-                
-                if LOG.isEnabledFor(logging.DEBUG):
-                    overlength_secs = entry["PlayDuration"] - runtime_sec
-                    overlength_percentage = 100 / runtime_sec * overlength_secs
-                    LOG.debug("capped playback duration of %ss of item id %s to runtime %ss (%ss=%s%%) [%s played a %s]", entry["PlayDuration"], entry["ItemId"], runtime_sec, overlength_secs, int(overlength_percentage), entry["ClientName"], entry["ItemType"])
-                else:
-                    LOG.info("capped playback duration of %ss of item id %s to runtime %ss", entry["PlayDuration"], entry["ItemId"], runtime_sec)
-    
-    updated_rowcount = pb_db_cur.executemany("""
-        UPDATE PlaybackActivity
-        SET PlayDuration = ?
-        WHERE ItemId = ?
-        AND PlaybackMethod is not NULL
-    """, capplaydur_items).rowcount
-    LOG.info("updated %s runtime entries of %s items", updated_rowcount, len(capplaydur_items))
+    capped_item_ids = set()
+    with METRICS.timer("cap.scan"):
+        for entry in pb_db_cur.execute("""
+            SELECT rowid, ItemId, PlayDuration, PlaybackMethod, ItemType, ClientName
+            FROM PlaybackActivity
+            WHERE PlaybackMethod is not NULL
+        """).fetchall():
+            if (runtime_sec := item_runtime_map.get(entry["ItemId"])) != None:
+                if entry["PlayDuration"] > runtime_sec:
+                    capplaydur_items.append((runtime_sec, entry["rowid"]))
+                    capped_item_ids.add(entry["ItemId"])
+                    
+                    if (len(capplaydur_items) - 1) % log_sample_every == 0 and LOG.isEnabledFor(logging.DEBUG):
+                        overlength_secs = entry["PlayDuration"] - runtime_sec
+                        overlength_percentage = 100 / runtime_sec * overlength_secs
+                        LOG.debug("capped playback duration of %ss of item id %s to runtime %ss (%ss=%s%%) [%s played a %s] (sample 1/%s)", entry["PlayDuration"], entry["ItemId"], runtime_sec, overlength_secs, int(overlength_percentage), entry["ClientName"], entry["ItemType"], log_sample_every)
+    
+    with METRICS.timer("cap.update"):
+        updated_rowcount = pb_db_cur.executemany("""
+            UPDATE PlaybackActivity
+            SET PlayDuration = ?
+            WHERE rowid = ?
+        """, capplaydur_items).rowcount
+    LOG.info("updated %s runtime entries of %s items", updated_rowcount, len(capped_item_ids))
+    METRICS.count("rows_capped", updated_rowcount)
+    
+    return updated_rowcount
+
+
+def attach_jellyfin_db(
+        pb_db_cur: sqlite3.Cursor,
+        jellyfin_db: Path,
+        schema: str = "jf",
+    ) -> None:
+    """
+    attaches the jellyfin database read-only to the playback activity database connection
+    
+    note: the connection has to be opened with uri=True and there must be no open transaction
+    """
+    global LOG
+    
+    jellyfin_db_uri = f"{jellyfin_db.absolute().as_uri()}?mode=ro"
+    pb_db_cur.execute(f"ATTACH DATABASE ? AS {schema}", (jellyfin_db_uri,))
+    LOG.info("attached %s read-only as %s", jellyfin_db_uri, schema)
+
+
+def cap_playduration_attached(
+        pb_db_cur: sqlite3.Cursor,
+        schema: str = "jf",
+    ) -> int:
+    """
+    caps every playback entry to the runtime of the played item with a single statement,
+    but skips entries where PlaybackMethod is NULL
+    
+    only entries that actually exceed the runtime are updated, the jellyfin database has to be attached as schema
+    
+    note: this function does not automatically commits the updated playback durations
+    """
+    global LOG, METRICS
+    
+    item_runtime_count = pb_db_cur.execute(f"""
+        SELECT COUNT(*)
+        FROM {schema}.BaseItems
+        WHERE RunTimeTicks is NOT NULL
+    """).fetchone()[0]
+    LOG.info("found %s base items with set runtime", item_runtime_count)
+    
+    # RETURNING needs sqlite 3.35 and UPDATE ... FROM needs sqlite 3.33
+    capped_item_ids = set()
+    updated_rowcount = 0
+    with METRICS.timer("cap.update"):
+        for entry in pb_db_cur.execute(f"""
+            UPDATE PlaybackActivity
+            SET PlayDuration = bi.RunTimeSec
+            FROM (
+                SELECT PresentationUniqueKey AS ItemId, RunTimeTicks / 10000000 AS RunTimeSec
+                FROM {schema}.BaseItems
+                WHERE RunTimeTicks is NOT NULL
+            ) AS bi
+            WHERE PlaybackActivity.ItemId = bi.ItemId
+            AND PlaybackActivity.PlaybackMethod is not NULL
+            AND PlaybackActivity.PlayDuration > bi.RunTimeSec
+            RETURNING PlaybackActivity.ItemId
+        """):
+            capped_item_ids.add(entry[0])
+            updated_rowcount += 1
+    LOG.info("updated %s runtime entries of %s items", updated_rowcount, len(capped_item_ids))
+    METRICS.count("rows_capped", updated_rowcount)
     
     return updated_rowcount
 
 
+def is_bucket_compact(
+        pb_db_cur: sqlite3.Cursor,
+        _from: dt.datetime,
+        to: dt.datetime,
+    ) -> bool:
+    """
+    checks if the playback activity in the given datetime range is already compressed, which is the case if all
+    activities are dated at the range start and there is only one activity per user per item, or if there is none
+    
+    both conditions are answered by the covering DateCreated index without reading the table
+    """
+    global METRICS
+    
+    from_datetimestr = _from.strftime(DATETIME_FORMAT)
+    to_datetimestr = to.strftime(DATETIME_FORMAT)
+    
+    with METRICS.timer("bucket.compact_check"):
+        return bool(pb_db_cur.execute("""
+            SELECT NOT EXISTS (
+                SELECT 1
+                FROM PlaybackActivity
+                WHERE DateCreated > ?
+                AND DateCreated < ?
+            )
+            AND NOT EXISTS (
+                SELECT 1
+                FROM PlaybackActivity
+                WHERE DateCreated = ?
+                GROUP BY UserId, ItemId
+                HAVING COUNT(*) > 1
+            )
+        """, (from_datetimestr, to_datetimestr, from_datetimestr)).fetchone()[0])
+
+
+def import_pyarrow() -> Optional[ModuleType]:
+    """
+    imports pyarrow only when the archive is written or read, so it stays an optional dependency of the archive
+    """
+    try:
+        # pip install pyarrow
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+class ActivityArchive:
+    """
+    append-only archive of raw playback activities partitioned by month, which keeps one part file per month open for
+    the whole run, so all buckets of a month end up in the same file of archive_dir/month=YYYY-MM/
+
+    the part files are zstd compressed parquet if pyarrow is installed or else gzip compressed csv, which can be
+    scanned back with read_archive
+    """
+
+    def __init__(self, archive_dir: Path) -> None:
+        self.archive_dir = archive_dir
+        self.pa = import_pyarrow()
+        self.schema = self.pa.schema([ (column, self.pa.int64() if column == "PlayDuration" else self.pa.string()) for column in ACTIVITY_COLUMNS ]) if self.pa is not None else None
+        self.writers: dict[str, Any] = {}
+        self.csv_files: list = []
+
+    def __enter__(self) -> "ActivityArchive":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, month: str, rows: list[sqlite3.Row]) -> None:
+        if (writer := self.writers.get(month)) is None:
+            month_dir = self.archive_dir / f"month={month}"
+            month_dir.mkdir(parents=True, exist_ok=True)
+            part_file = month_dir / f"part-{time.time_ns()}"
+            if self.pa is not None:
+                writer = self.pa.parquet.ParquetWriter(part_file.with_suffix(".parquet"), self.schema, compression="zstd")
+            else:
+                self.csv_files.append(gzip.open(part_file.with_suffix(".csv.gz"), "wt", encoding="utf-8", newline=""))
+                writer = csv.writer(self.csv_files[-1])
+                writer.writerow(ACTIVITY_COLUMNS)
+            self.writers[month] = writer
+        
+        if self.pa is not None:
+            writer.write_table(self.pa.Table.from_pylist([ dict(row) for row in rows ], schema=self.schema))
+        else:
+            writer.writerows(rows)
+
+    def close(self) -> None:
+        if self.pa is not None:
+            for writer in self.writers.values():
+                writer.close()
+        for csv_file in self.csv_files:
+            csv_file.close()
+        self.writers.clear()
+        self.csv_files.clear()
+
+
+def archive_activity_range(
+        pb_db_cur: sqlite3.Cursor,
+        _from: dt.datetime,
+        to: dt.datetime,
+        archive: ActivityArchive,
+        batch_size: int,
+    ) -> int:
+    """
+    streams the raw playback activity in the given datetime range into the archive, already compressed activities are
+    skipped, because they are the aggregates of previously archived activities
+    
+    note: archiving the same range twice, e.g. if the compression failed after archiving, duplicates its activities
+    """
+    global LOG, METRICS
+    
+    from_datetimestr = _from.strftime(DATETIME_FORMAT)
+    to_datetimestr = to.strftime(DATETIME_FORMAT)
+    
+    pb_db_cur.execute(f"""
+        SELECT {", ".join(ACTIVITY_COLUMNS)}
+        FROM PlaybackActivity
+        WHERE DateCreated >= ?
+        AND DateCreated < ?
+        AND {RAW_ACTIVITY_CONDITION}
+        ORDER BY DateCreated
+    """, (from_datetimestr, to_datetimestr))
+    
+    with METRICS.timer("archive"):
+        months: set[str] = set()
+        archived_rowcount = 0
+        for batch in iter_batches(pb_db_cur, batch_size):
+            # the activities are ordered, so a batch is split into consecutive months
+            month_rows: dict[str, list[sqlite3.Row]] = {}
+            for row in batch:
+                month_rows.setdefault(row["DateCreated"][:7], []).append(row)
+            
+            for month, rows in month_rows.items():
+                archive.write(month, rows)
+            months.update(month_rows)
+            archived_rowcount += len(batch)
+    
+    LOG.info("archived %s raw activities between %s and %s into %s monthly partitions", archived_rowcount, from_datetimestr, to_datetimestr, len(months))
+    METRICS.count("rows_archived", archived_rowcount)
+    return archived_rowcount
+
+
+def read_archive(
+        archive_dir: Path,
+        _from: Optional[dt.datetime] = None,
+        to: Optional[dt.datetime] = None,
+    ) -> Iterator[dict[str, Any]]:
+    """
+    yields all archived activities with _from <= activity < to from the monthly partitions, in the same format as the
+    rows of the PlaybackActivity table, and only opens the partitions of the months in range
+    """
+    from_datetimestr = _from.strftime(DATETIME_FORMAT) if _from is not None else ""
+    to_datetimestr = to.strftime(DATETIME_FORMAT) if to is not None else "~"
+    pa = None
+    
+    for month_dir in sorted(archive_dir.glob("month=*")):
+        month = month_dir.name.removeprefix("month=")
+        if month < from_datetimestr[:7] or month > to_datetimestr[:7]:
+            continue
+        
+        for part_file in sorted(month_dir.glob("part-*")):
+            if part_file.suffix == ".parquet":
+                if pa is None and (pa := import_pyarrow()) is None:
+                    raise ImportError(f"pyarrow is required to read {part_file}")
+                with pa.parquet.ParquetFile(part_file) as parquet_file:
+                    for batch in parquet_file.iter_batches():
+                        for row in batch.to_pylist():
+                            if from_datetimestr <= row["DateCreated"] < to_datetimestr:
+                                yield row
+            else:
+                with gzip.open(part_file, "rt", encoding="utf-8", newline="") as csv_file:
+                    for row in csv.DictReader(csv_file):
+                        # csv stores NULL as empty string
+                        row = { column: (int(value) if column == "PlayDuration" else value) if value != "" else None for column, value in row.items() }
+                        if from_datetimestr <= row["DateCreated"] < to_datetimestr:
+                            yield row
+
+
 def compress_activity_range(
         pb_db_cur: sqlite3.Cursor,
         _from: dt.datetime,
         to: dt.datetime,
+        daily_totals: bool = False,
     ) -> list[sqlite3.Row]:
     """
-    compresses all playback activity per user per item in the given datetime range: _from <= activity < to
+    compresses all playback activity per user per item in the given datetime range: _from <= activity < to,
+    and folds the raw activities into the daily totals before they are deleted if daily_totals is set
     
     note: this function does not automatically commits the deleted and inserted playback activities
     """
-    global LOG
+    global LOG, METRICS
 
-    from_datetimestr = _from.isoformat()
-    to_datetimestr = to.isoformat()
+    from_datetimestr = _from.strftime(DATETIME_FORMAT)
+    to_datetimestr = to.strftime(DATETIME_FORMAT)
     
-    compressed_activity = pb_db_cur.execute("""
-        SELECT UserId, ItemId, ItemType, ItemName, SUM(PlayDuration) AS TotalPlayDuration
-        FROM PlaybackActivity
-        WHERE datetime(DateCreated) >= datetime(?)
-        AND datetime(DateCreated) < datetime(?)
-        GROUP BY UserId, ItemId
-    """, (from_datetimestr, to_datetimestr)).fetchall()
+    with METRICS.timer("bucket.select"):
+        compressed_activity = pb_db_cur.execute("""
+            SELECT UserId, ItemId, ItemType, ItemName, SUM(PlayDuration) AS TotalPlayDuration
+            FROM PlaybackActivity
+            WHERE DateCreated >= ?
+            AND DateCreated < ?
+            GROUP BY UserId, ItemId
+        """, (from_datetimestr, to_datetimestr)).fetchall()
     LOG.info("compressed playback activity between %s and %s per user per item into %s entries", from_datetimestr, to_datetimestr, len(compressed_activity))
 
-    deleted_activity_rowcount = pb_db_cur.execute("""
-        DELETE
-        FROM PlaybackActivity
-        WHERE datetime(DateCreated) >= datetime(?)
-        AND datetime(DateCreated) < datetime(?)
-    """, (from_datetimestr, to_datetimestr)).rowcount
+    if daily_totals:
+        update_daily_totals(pb_db_cur, f"DateCreated >= ? AND DateCreated < ? AND {RAW_ACTIVITY_CONDITION}", (from_datetimestr, to_datetimestr))
+
+    with METRICS.timer("bucket.delete"):
+        deleted_activity_rowcount = pb_db_cur.execute("""
+            DELETE
+            FROM PlaybackActivity
+            WHERE DateCreated >= ?
+            AND DateCreated < ?
+        """, (from_datetimestr, to_datetimestr)).rowcount
     LOG.info("deleted %s activity entries between %s and %s", deleted_activity_rowcount, from_datetimestr, to_datetimestr)
     
-    inserted_activity_rowcount = pb_db_cur.executemany(f"""
-        INSERT INTO PlaybackActivity
-        VALUES (datetime('{from_datetimestr}'), :UserId, :ItemId, :ItemType, :ItemName, NULL, NULL, NULL, :TotalPlayDuration)
-    """, compressed_activity).rowcount
+    with METRICS.timer("bucket.insert"):
+        inserted_activity_rowcount = pb_db_cur.executemany("""
+            INSERT INTO PlaybackActivity
+            VALUES (:DateCreated, :UserId, :ItemId, :ItemType, :ItemName, NULL, NULL, NULL, :TotalPlayDuration)
+        """, [ {"DateCreated": from_datetimestr, **activity} for activity in map(dict, compressed_activity) ]).rowcount
     LOG.info("inserted %s compressed playback activities dated at %s", inserted_activity_rowcount, from_datetimestr)
+    METRICS.count("rows_deleted", deleted_activity_rowcount)
+    METRICS.count("rows_inserted", inserted_activity_rowcount)
     
     return compressed_activity
 
 
+def iter_batches(
+        db_cur: sqlite3.Cursor,
+        batch_size: int,
+    ) -> Iterator[list[sqlite3.Row]]:
+    """
+    yields the remaining rows of an executed query in chunks of at most batch_size rows
+    """
+    while (batch := db_cur.fetchmany(batch_size)):
+        yield batch
+
+
+def get_peak_rss() -> Optional[int]:
+    """
+    returns the peak resident set size of this process in bytes, or None if it cannot be determined
+    """
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macos bytes
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, "peak_wset", memory_info.rss)
+    return None
+
+
+def cap_playduration_streaming(
+        pb_db_cur: sqlite3.Cursor,
+        jf_db_cur: sqlite3.Cursor,
+        batch_size: int,
+    ) -> int:
+    """
+    caps every playback entry to the runtime of the played item like cap_playduration, but reads the playback activity
+    in chunks and writes the capped durations per row in batches, so the memory usage does not grow with the table size
+    
+    note: this function does not automatically commits the updated playback durations
+    """
+    global LOG, METRICS
+    
+    with METRICS.timer("cap.load_runtimes"):
+        item_runtime_map = {
+            i["ItemId"]: i["RunTimeSec"]
+            for i in jf_db_cur.execute("""
+                SELECT PresentationUniqueKey AS ItemId, RunTimeTicks / 10000000 AS RunTimeSec
+                FROM BaseItems
+                WHERE RunTimeTicks is NOT NULL
+            """)
+        }
+    LOG.info("found %s base items with set runtime", len(item_runtime_map))
+    
+    # the updates go through their own cursor to not reset the running select
+    pb_db_write_cur = pb_db_cur.connection.cursor()
+    with METRICS.timer("cap.scan_update"):
+        pb_db_cur.execute("""
+            SELECT rowid, ItemId, PlayDuration
+            FROM PlaybackActivity
+            WHERE PlaybackMethod is not NULL
+        """)
+    
+        capped_item_ids = set()
+        updated_rowcount = 0
+        for batch in iter_batches(pb_db_cur, batch_size):
+            capplaydur_rows: list[tuple] = []
+            for entry in batch:
+                if (runtime_sec := item_runtime_map.get(entry["ItemId"])) is not None and entry["PlayDuration"] > runtime_sec:
+                    capplaydur_rows.append((runtime_sec, entry["rowid"]))
+                    capped_item_ids.add(entry["ItemId"])
+            if len(capplaydur_rows) == 0:
+                continue
+        
+            updated_rowcount += pb_db_write_cur.executemany("""
+                UPDATE PlaybackActivity
+                SET PlayDuration = ?
+                WHERE rowid = ?
+            """, capplaydur_rows).rowcount
+            LOG.debug("capped %s playback durations of batch", len(capplaydur_rows))
+    LOG.info("updated %s runtime entries of %s items", updated_rowcount, len(capped_item_ids))
+    METRICS.count("rows_capped", updated_rowcount)
+    
+    return updated_rowcount
+
+
+def compress_activity_range_streaming(
+        pb_db_cur: sqlite3.Cursor,
+        _from: dt.datetime,
+        to: dt.datetime,
+        batch_size: int,
+        daily_totals: bool = False,
+    ) -> int:
+    """
+    compresses all playback activity per user per item in the given datetime range like compress_activity_range,
+    but inserts the compressed activities in batches while reading them and returns only their count
+    
+    the compressed activities are inserted before the originals are deleted, so the originals are limited to the rowids
+    that existed before the first insert
+    
+    note: this function does not automatically commits the deleted and inserted playback activities
+    """
+    global LOG, METRICS
+    
+    from_datetimestr = _from.strftime(DATETIME_FORMAT)
+    to_datetimestr = to.strftime(DATETIME_FORMAT)
+    max_rowid = pb_db_cur.execute("SELECT IFNULL(MAX(rowid), 0) FROM PlaybackActivity").fetchone()[0]
+    
+    pb_db_write_cur = pb_db_cur.connection.cursor()
+    with METRICS.timer("bucket.select_insert"):
+        pb_db_cur.execute("""
+            SELECT UserId, ItemId, ItemType, ItemName, SUM(PlayDuration) AS TotalPlayDuration
+            FROM PlaybackActivity
+            WHERE DateCreated >= ?
+            AND DateCreated < ?
+            AND rowid <= ?
+            GROUP BY UserId, ItemId
+        """, (from_datetimestr, to_datetimestr, max_rowid))
+    
+        inserted_activity_rowcount = 0
+        for batch in iter_batches(pb_db_cur, batch_size):
+            inserted_activity_rowcount += pb_db_write_cur.executemany("""
+                INSERT INTO PlaybackActivity
+                VALUES (:DateCreated, :UserId, :ItemId, :ItemType, :ItemName, NULL, NULL, NULL, :TotalPlayDuration)
+            """, ( {"DateCreated": from_datetimestr, **activity} for activity in map(dict, batch) )).rowcount
+    LOG.info("inserted %s compressed playback activities dated at %s", inserted_activity_rowcount, from_datetimestr)
+    
+    if daily_totals:
+        update_daily_totals(pb_db_write_cur, f"DateCreated >= ? AND DateCreated < ? AND rowid <= ? AND {RAW_ACTIVITY_CONDITION}", (from_datetimestr, to_datetimestr, max_rowid))
+    
+    with METRICS.timer("bucket.delete"):
+        deleted_activity_rowcount = pb_db_write_cur.execute("""
+            DELETE
+            FROM PlaybackActivity
+            WHERE DateCreated >= ?
+            AND DateCreated < ?
+            AND rowid <= ?
+        """, (from_datetimestr, to_datetimestr, max_rowid)).rowcount
+    LOG.info("deleted %s activity entries between %s and %s", deleted_activity_rowcount, from_datetimestr, to_datetimestr)
+    METRICS.count("rows_deleted", deleted_activity_rowcount)
+    METRICS.count("rows_inserted", inserted_activity_rowcount)
+    
+    return inserted_activity_rowcount
+
+
+def enable_online_mode(
+        pb_db_cur: sqlite3.Cursor,
+        busy_timeout_ms: int,
+    ) -> None:
+    """
+    switches the playback activity database to WAL, so readers and the plugin's writes are not blocked by long reads,
+    and sets how long a statement waits for a lock before failing with SQLITE_BUSY
+    """
+    global LOG
+    
+    journal_mode = pb_db_cur.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    pb_db_cur.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+    LOG.info("enabled online mode with journal mode %s and busy timeout of %sms", journal_mode, busy_timeout_ms)
+
+
+def is_busy_error(error: sqlite3.OperationalError) -> bool:
+    """
+    checks if the error was raised because another connection holds the lock
+    """
+    if (errorcode := getattr(error, "sqlite_errorcode", None)) is not None:
+        return errorcode & 0xff in {sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED}
+    return "locked" in str(error) or "busy" in str(error)
+
+
+def run_write_transaction(
+        pb_db_cur: sqlite3.Cursor,
+        statements: Callable[[sqlite3.Cursor], Any],
+        max_retries: int,
+        retry_backoff_sec: float,
+    ) -> tuple[Any, float]:
+    """
+    runs the statements in their own immediate transaction and commits them, and retries the whole transaction with
+    exponential backoff if the database is busy
+    
+    returns the result of the statements and the seconds the write lock was held
+    
+    note: there must be no open transaction
+    """
+    global LOG, METRICS
+    
+    pb_db_conn = pb_db_cur.connection
+    for attempt in range(max_retries + 1):
+        try:
+            pb_db_cur.execute("BEGIN IMMEDIATE")
+            locked_at = time.perf_counter()
+            result = statements(pb_db_cur)
+            pb_db_conn.commit()
+            locked_sec = time.perf_counter() - locked_at
+            METRICS.record("write_lock", locked_sec)
+            return result, locked_sec
+        
+        except sqlite3.OperationalError as error:
+            if pb_db_conn.in_transaction:
+                pb_db_conn.rollback()
+            if not is_busy_error(error) or attempt >= max_retries:
+                raise
+            backoff_sec = retry_backoff_sec * 2**attempt
+            LOG.warning("database is busy, retry %s/%s in %.2fs: %s", attempt + 1, max_retries, backoff_sec, error)
+            time.sleep(backoff_sec)
+
+
+def cap_playduration_online(
+        pb_db_cur: sqlite3.Cursor,
+        jf_db_cur: sqlite3.Cursor,
+        batch_size: int,
+        max_retries: int,
+        retry_backoff_sec: float,
+    ) -> int:
+    """
+    caps every playback entry to the runtime of the played item like cap_playduration_streaming, but collects the rowids
+    of the entries to cap without holding the write lock and caps them in short transactions of at most batch_size
+    entries each, which are retried like the online compression
+    
+    an entry is only capped if it still exceeds the runtime, so a duration changed in the meantime is never raised
+    
+    note: this function commits on its own and there must be no open transaction
+    """
+    global LOG, METRICS
+    
+    with METRICS.timer("cap.load_runtimes"):
+        item_runtime_map = {
+            i["ItemId"]: i["RunTimeSec"]
+            for i in jf_db_cur.execute("""
+                SELECT PresentationUniqueKey AS ItemId, RunTimeTicks / 10000000 AS RunTimeSec
+                FROM BaseItems
+                WHERE RunTimeTicks is NOT NULL
+            """)
+        }
+    LOG.info("found %s base items with set runtime", len(item_runtime_map))
+    
+    capplaydur_rows: list[tuple] = []
+    capped_item_ids = set()
+    with METRICS.timer("cap.scan"):
+        for entry in pb_db_cur.execute("""
+            SELECT rowid, ItemId, PlayDuration
+            FROM PlaybackActivity
+            WHERE PlaybackMethod is not NULL
+        """):
+            if (runtime_sec := item_runtime_map.get(entry["ItemId"])) is not None and entry["PlayDuration"] > runtime_sec:
+                capplaydur_rows.append((runtime_sec, entry["rowid"], runtime_sec))
+                capped_item_ids.add(entry["ItemId"])
+    
+    def cap_rows(rows: list[tuple]) -> Callable[[sqlite3.Cursor], int]:
+        def statements(db_cur: sqlite3.Cursor) -> int:
+            return db_cur.executemany("""
+                UPDATE PlaybackActivity
+                SET PlayDuration = ?
+                WHERE rowid = ?
+                AND PlayDuration > ?
+            """, rows).rowcount
+        return statements
+    
+    updated_rowcount = 0
+    with METRICS.timer("cap.update"):
+        for offset in range(0, len(capplaydur_rows), batch_size):
+            capped_rowcount, locked_sec = run_write_transaction(pb_db_cur, cap_rows(capplaydur_rows[offset:offset + batch_size]), max_retries, retry_backoff_sec)
+            updated_rowcount += capped_rowcount
+            LOG.debug("capped %s playback durations in %.3fs", capped_rowcount, locked_sec)
+    LOG.info("updated %s runtime entries of %s items", updated_rowcount, len(capped_item_ids))
+    METRICS.count("rows_capped", updated_rowcount)
+    
+    return updated_rowcount
+
+
+def compress_activity_range_online(
+        pb_db_cur: sqlite3.Cursor,
+        _from: dt.datetime,
+        to: dt.datetime,
+        batch_size: int,
+        max_retries: int,
+        retry_backoff_sec: float,
+        daily_totals: bool = False,
+    ) -> int:
+    """
+    compresses all playback activity per user per item in the given datetime range like compress_activity_range,
+    but replaces the activities in short transactions of at most batch_size user/item groups each, so the write lock
+    is never held for a whole bucket
+    
+    the groups are numbered in temporary tables first, each transaction then inserts the compressed activities of its
+    groups and deletes their originals, so the totals stay consistent after every commit
+    
+    note: this function commits on its own and there must be no open transaction
+    """
+    global LOG, METRICS
+    
+    from_datetimestr = _from.strftime(DATETIME_FORMAT)
+    to_datetimestr = to.strftime(DATETIME_FORMAT)
+    max_rowid = pb_db_cur.execute("SELECT IFNULL(MAX(rowid), 0) FROM PlaybackActivity").fetchone()[0]
+    parameters = (from_datetimestr, to_datetimestr, max_rowid)
+    
+    with METRICS.timer("bucket.prepare"):
+        # both tables order the groups the same way, so the row number of a group equals the dense rank of its activities
+        pb_db_cur.execute("DROP TABLE IF EXISTS temp.OnlineCompressedActivity")
+        pb_db_cur.execute("""
+            CREATE TEMP TABLE OnlineCompressedActivity AS
+            SELECT ROW_NUMBER() OVER (ORDER BY UserId, ItemId) AS GroupNo, UserId, ItemId, ItemType, ItemName, SUM(PlayDuration) AS TotalPlayDuration
+            FROM PlaybackActivity
+            WHERE DateCreated >= ?
+            AND DateCreated < ?
+            AND rowid <= ?
+            GROUP BY UserId, ItemId
+        """, parameters)
+        pb_db_cur.execute("DROP TABLE IF EXISTS temp.OnlineActivityGroups")
+        pb_db_cur.execute("""
+            CREATE TEMP TABLE OnlineActivityGroups AS
+            SELECT rowid AS ActivityRowId, DENSE_RANK() OVER (ORDER BY UserId, ItemId) AS GroupNo
+            FROM PlaybackActivity
+            WHERE DateCreated >= ?
+            AND DateCreated < ?
+            AND rowid <= ?
+        """, parameters)
+        pb_db_cur.execute("CREATE INDEX temp.idx_OnlineActivityGroups_GroupNo ON OnlineActivityGroups (GroupNo)")
+    group_count = pb_db_cur.execute("SELECT COUNT(*) FROM temp.OnlineCompressedActivity").fetchone()[0]
+    
+    def replace_groups(first_group: int, last_group: int) -> Callable[[sqlite3.Cursor], tuple[int, int]]:
+        def statements(db_cur: sqlite3.Cursor) -> tuple[int, int]:
+            inserted_rowcount = db_cur.execute("""
+                INSERT INTO PlaybackActivity
+                SELECT ?, UserId, ItemId, ItemType, ItemName, NULL, NULL, NULL, TotalPlayDuration
+                FROM temp.OnlineCompressedActivity
+                WHERE GroupNo BETWEEN ? AND ?
+            """, (from_datetimestr, first_group, last_group)).rowcount
+            if daily_totals:
+                update_daily_totals(db_cur, f"rowid IN (SELECT ActivityRowId FROM temp.OnlineActivityGroups WHERE GroupNo BETWEEN ? AND ?) AND {RAW_ACTIVITY_CONDITION}", (first_group, last_group))
+            deleted_rowcount = db_cur.execute("""
+                DELETE
+                FROM PlaybackActivity
+                WHERE rowid IN (
+                    SELECT ActivityRowId
+                    FROM temp.OnlineActivityGroups
+                    WHERE GroupNo BETWEEN ? AND ?
+                )
+            """, (first_group, last_group)).rowcount
+            return inserted_rowcount, deleted_rowcount
+        return statements
+    
+    inserted_activity_rowcount = 0
+    deleted_activity_rowcount = 0
+    lock_secs: list[float] = []
+    for first_group in range(1, group_count + 1, batch_size):
+        last_group = min(first_group + batch_size - 1, group_count)
+        with METRICS.timer("bucket.transaction"):
+            (inserted_rowcount, deleted_rowcount), locked_secs = run_write_transaction(pb_db_cur, replace_groups(first_group, last_group), max_retries, retry_backoff_sec)
+        inserted_activity_rowcount += inserted_rowcount
+        deleted_activity_rowcount += deleted_rowcount
+        lock_secs.append(locked_secs)
+        LOG.info("held write lock for %.1fms to replace %s by %s activities dated at %s", locked_secs * 1000, deleted_rowcount, inserted_rowcount, from_datetimestr)
+    
+    pb_db_cur.execute("DROP TABLE temp.OnlineActivityGroups")
+    pb_db_cur.execute("DROP TABLE temp.OnlineCompressedActivity")
+    
+    LOG.info("replaced %s activity entries between %s and %s by %s compressed activities in %s transactions (longest write lock %.1fms)", deleted_activity_rowcount, from_datetimestr, to_datetimestr, inserted_activity_rowcount, len(lock_secs), max(lock_secs, default=0) * 1000)
+    METRICS.count("rows_deleted", deleted_activity_rowcount)
+    METRICS.count("rows_inserted", inserted_activity_rowcount)
+    return inserted_activity_rowcount
+
+
+def compress_activity_rollup(
+        pb_db_cur: sqlite3.Cursor,
+        buckets: list[Bucket],
+        skip_compact: bool = False,
+        daily_totals: bool = False,
+    ) -> int:
+    """
+    compresses all playback activity per user per item for every given retention bucket at once
+    
+    the bucket boundaries are registered as a temporary table, so the number of statements stays the same
+    no matter how many buckets the retention policy creates
+    
+    note: this function does not automatically commits the deleted and inserted playback activities
+    """
+    global LOG, METRICS
+    
+    pb_db_cur.execute("DROP TABLE IF EXISTS temp.RetentionBuckets")
+    pb_db_cur.execute("""
+        CREATE TEMP TABLE RetentionBuckets (
+            BucketStart TEXT PRIMARY KEY,
+            BucketEnd   TEXT NOT NULL
+        )
+    """)
+    pb_db_cur.executemany("""
+        INSERT INTO temp.RetentionBuckets
+        VALUES (?, ?)
+    """, [ (_from.strftime(DATETIME_FORMAT), to.strftime(DATETIME_FORMAT)) for _from, to, _ in buckets ])
+    LOG.info("registered %s retention buckets", len(buckets))
+    
+    # the same conditions as is_bucket_compact for all buckets at once
+    if skip_compact:
+        with METRICS.timer("rollup.compact_check"):
+            skipped_bucket_count = pb_db_cur.execute("""
+                DELETE
+                FROM temp.RetentionBuckets AS b
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM PlaybackActivity AS pa
+                    WHERE pa.DateCreated > b.BucketStart
+                    AND pa.DateCreated < b.BucketEnd
+                )
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM PlaybackActivity AS pa
+                    WHERE pa.DateCreated = b.BucketStart
+                    GROUP BY pa.UserId, pa.ItemId
+                    HAVING COUNT(*) > 1
+                )
+            """).rowcount
+        LOG.info("skipped %s already compact buckets and rewrite %s buckets", skipped_bucket_count, len(buckets) - skipped_bucket_count)
+        METRICS.count("buckets_skipped_compact", skipped_bucket_count)
+    
+    with METRICS.timer("rollup.select"):
+        pb_db_cur.execute("DROP TABLE IF EXISTS temp.CompressedActivity")
+        pb_db_cur.execute("""
+            CREATE TEMP TABLE CompressedActivity AS
+            SELECT b.BucketStart AS DateCreated, pa.UserId, pa.ItemId, pa.ItemType, pa.ItemName, SUM(pa.PlayDuration) AS TotalPlayDuration
+            FROM temp.RetentionBuckets AS b
+            JOIN PlaybackActivity AS pa
+            ON pa.DateCreated >= b.BucketStart
+            AND pa.DateCreated < b.BucketEnd
+            GROUP BY b.BucketStart, pa.UserId, pa.ItemId
+        """)
+    
+    # the buckets do not need to be contiguous, each one is still resolved by an index range scan
+    bucket_rowids = """
+        SELECT pa.rowid
+        FROM temp.RetentionBuckets AS b
+        JOIN PlaybackActivity AS pa
+        ON pa.DateCreated >= b.BucketStart
+        AND pa.DateCreated < b.BucketEnd
+    """
+    if daily_totals:
+        update_daily_totals(pb_db_cur, f"rowid IN ({bucket_rowids}) AND {RAW_ACTIVITY_CONDITION}")
+    
+    with METRICS.timer("rollup.delete"):
+        deleted_activity_rowcount = pb_db_cur.execute(f"""
+            DELETE
+            FROM PlaybackActivity
+            WHERE rowid IN ({bucket_rowids})
+        """).rowcount
+    LOG.info("deleted %s activity entries of all retention buckets", deleted_activity_rowcount)
+    
+    with METRICS.timer("rollup.insert"):
+        inserted_activity_rowcount = pb_db_cur.execute("""
+            INSERT INTO PlaybackActivity
+            SELECT DateCreated, UserId, ItemId, ItemType, ItemName, NULL, NULL, NULL, TotalPlayDuration
+            FROM temp.CompressedActivity
+        """).rowcount
+    LOG.info("inserted %s compressed playback activities into all retention buckets", inserted_activity_rowcount)
+    METRICS.count("rows_deleted", deleted_activity_rowcount)
+    METRICS.count("rows_inserted", inserted_activity_rowcount)
+    
+    pb_db_cur.execute("DROP TABLE temp.CompressedActivity")
+    pb_db_cur.execute("DROP TABLE temp.RetentionBuckets")
+    
+    return inserted_activity_rowcount
+
+
+def plan_compression(
+        pb_db_cur: sqlite3.Cursor,
+        buckets: list[Bucket],
+    ) -> list[dict[str, Any]]:
+    """
+    computes for every bucket the current number of activities, the number after compression and the estimated bytes
+    reclaimed in one aggregate query, without modifying the playback activity database
+    
+    the byte estimate is based on the stored value lengths of each row plus ROW_OVERHEAD_BYTES
+    """
+    global LOG
+    
+    pb_db_cur.execute("DROP TABLE IF EXISTS temp.PlanBuckets")
+    pb_db_cur.execute("""
+        CREATE TEMP TABLE PlanBuckets (
+            BucketStart TEXT PRIMARY KEY,
+            BucketEnd   TEXT NOT NULL,
+            Granularity TEXT NOT NULL
+        )
+    """)
+    pb_db_cur.executemany("""
+        INSERT INTO temp.PlanBuckets
+        VALUES (?, ?, ?)
+    """, [ (_from.strftime(DATETIME_FORMAT), to.strftime(DATETIME_FORMAT), step) for _from, to, step in buckets ])
+    
+    row_bytes = " + ".join([ f"IFNULL(LENGTH(CAST(pa.{column} AS BLOB)), 0)" for column in ["DateCreated", "UserId", "ItemId", "ItemType", "ItemName", "PlaybackMethod", "ClientName", "DeviceName"] ])
+    compressed_row_bytes = " + ".join([ f"IFNULL(LENGTH(CAST(pa.{column} AS BLOB)), 0)" for column in ["UserId", "ItemId", "ItemType", "ItemName"] ])
+    plan = [ dict(row) for row in pb_db_cur.execute(f"""
+        SELECT b.Granularity, b.BucketStart, b.BucketEnd,
+            IFNULL(SUM(g.GroupRows), 0) AS CurrentRows,
+            COUNT(g.GroupRows) AS CompressedRows,
+            IFNULL(SUM(g.GroupBytes), 0) - IFNULL(SUM(g.CompressedBytes), 0) AS ReclaimedBytes
+        FROM temp.PlanBuckets AS b
+        LEFT JOIN (
+            SELECT b.BucketStart, pa.UserId, pa.ItemId,
+                COUNT(*) AS GroupRows,
+                SUM({row_bytes} + 8 + {ROW_OVERHEAD_BYTES}) AS GroupBytes,
+                MAX(LENGTH(b.BucketStart) + {compressed_row_bytes} + 8 + {ROW_OVERHEAD_BYTES}) AS CompressedBytes
+            FROM temp.PlanBuckets AS b
+            JOIN PlaybackActivity AS pa
+            ON pa.DateCreated >= b.BucketStart
+            AND pa.DateCreated < b.BucketEnd
+            GROUP BY b.BucketStart, pa.UserId, pa.ItemId
+        ) AS g
+        ON g.BucketStart = b.BucketStart
+        GROUP BY b.BucketStart
+        ORDER BY b.BucketStart DESC
+    """) ]
+    pb_db_cur.execute("DROP TABLE temp.PlanBuckets")
+    
+    LOG.info("planned compression of %s buckets", len(plan))
+    return plan
+
+
+def print_plan(
+        plan: list[dict[str, Any]],
+        plan_format: str = "table",
+    ) -> None:
+    """
+    prints the compression plan as aligned table or as json document including the totals
+    """
+    totals = {
+        "CurrentRows": sum([ bucket["CurrentRows"] for bucket in plan ]),
+        "CompressedRows": sum([ bucket["CompressedRows"] for bucket in plan ]),
+        "ReclaimedBytes": sum([ bucket["ReclaimedBytes"] for bucket in plan ]),
+    }
+    
+    if plan_format == "json":
+        print(json.dumps({"buckets": plan, "totals": totals}, indent=2))
+        return
+    if plan_format != "table":
+        raise ValueError(f"unknown plan format '{plan_format}'")
+    
+    header = f"{'step':<4}  {'from':<19}  {'to':<19}  {'rows':>12}  {'compressed':>12}  {'reduction':>9}  {'reclaimed':>12}"
+    print(header)
+    print("-" * len(header))
+    for bucket in [ *plan, {"Granularity": "", "BucketStart": "total", "BucketEnd": "", **totals} ]:
+        reduction = 100 - 100 * bucket["CompressedRows"] / bucket["CurrentRows"] if bucket["CurrentRows"] > 0 else 0
+        print(f"{bucket['Granularity']:<4}  {bucket['BucketStart']:<19}  {bucket['BucketEnd']:<19}  {bucket['CurrentRows']:>12}  {bucket['CompressedRows']:>12}  {reduction:>8.1f}%  {bucket['ReclaimedBytes'] / 1024:>10.1f}KB")
+
+
+def ensure_watermark_table(pb_db_cur: sqlite3.Cursor) -> None:
+    """
+    creates the side table that records the already compressed retention buckets if it does not exist yet
+    """
+    pb_db_cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+            Granularity    TEXT NOT NULL,
+            BucketStart    TEXT NOT NULL,
+            BucketEnd      TEXT NOT NULL,
+            MaxDateCreated TEXT NOT NULL,
+            MaxRowId       INTEGER NOT NULL,
+            PRIMARY KEY (BucketStart, BucketEnd)
+        )
+    """)
+
+
+def filter_compressed_buckets(
+        pb_db_cur: sqlite3.Cursor,
+        buckets: list[Bucket],
+    ) -> list[Bucket]:
+    """
+    returns only the buckets that need to be compressed, skipping every bucket that was already compressed by a previous
+    run and ended before the latest activity of that run, unless an activity was added to it since then
+    
+    activities reported late with an older DateCreated are found by their rowid, which is larger than the largest rowid
+    at the end of the previous run, so only the activities added since then are read
+    """
+    global LOG
+    
+    compressed_buckets = {
+        (row["BucketStart"], row["BucketEnd"]): row["MaxDateCreated"]
+        for row in pb_db_cur.execute(f"""
+            SELECT BucketStart, BucketEnd, MaxDateCreated
+            FROM {WATERMARK_TABLE}
+        """)
+    }
+    max_rowid = pb_db_cur.execute(f"""
+        SELECT IFNULL(MAX(MaxRowId), 0)
+        FROM {WATERMARK_TABLE}
+    """).fetchone()[0]
+    added_datetimestrs = sorted( row[0] for row in pb_db_cur.execute("""
+        SELECT DISTINCT DateCreated
+        FROM PlaybackActivity
+        WHERE rowid > ?
+    """, (max_rowid, )) )
+    
+    pending_buckets: list[Bucket] = []
+    for _from, to, step in buckets:
+        from_datetimestr = _from.strftime(DATETIME_FORMAT)
+        to_datetimestr = to.strftime(DATETIME_FORMAT)
+        max_datetimestr = compressed_buckets.get((from_datetimestr, to_datetimestr))
+        added_index = bisect.bisect_left(added_datetimestrs, from_datetimestr)
+        has_added_activity = added_index < len(added_datetimestrs) and added_datetimestrs[added_index] < to_datetimestr
+        if max_datetimestr is None or to_datetimestr > max_datetimestr or has_added_activity:
+            pending_buckets.append((_from, to, step))
+    
+    LOG.info("skipped %s of %s buckets that are already compressed according to the watermark", len(buckets) - len(pending_buckets), len(buckets))
+    return pending_buckets
+
+
+def store_watermark(
+        pb_db_cur: sqlite3.Cursor,
+        buckets: list[Bucket],
+        max_datetime: dt.datetime,
+    ) -> None:
+    """
+    replaces the watermark with the given buckets, which must be all buckets of the current run, and the largest rowid
+    after their compression
+    
+    note: this function does not automatically commits the watermark
+    """
+    global LOG
+    
+    max_datetimestr = max_datetime.strftime(DATETIME_FORMAT)
+    max_rowid = pb_db_cur.execute("SELECT IFNULL(MAX(rowid), 0) FROM PlaybackActivity").fetchone()[0]
+    pb_db_cur.execute(f"DELETE FROM {WATERMARK_TABLE}")
+    pb_db_cur.executemany(f"""
+        INSERT INTO {WATERMARK_TABLE}
+        VALUES (?, ?, ?, ?, ?)
+    """, [ (step, _from.strftime(DATETIME_FORMAT), to.strftime(DATETIME_FORMAT), max_datetimestr, max_rowid) for _from, to, step in buckets ])
+    LOG.info("stored watermark of %s buckets at %s", len(buckets), max_datetimestr)
+
+
+def ensure_daily_totals_tables(pb_db_cur: sqlite3.Cursor) -> None:
+    """
+    creates the per day totals tables if they do not exist yet and fills them once with the already compressed
+    activities, which are never folded again, dated at the day of their bucket start
+    
+    Day is the date part 'YYYY-MM-DD' of DateCreated, PlayCount the number of folded activities and PlayDuration their
+    summed (capped) play duration in seconds
+    
+    note: this function does not automatically commits the created tables
+    """
+    global LOG
+    
+    tables_exist = pb_db_cur.execute("""
+        SELECT COUNT(*) = 2
+        FROM sqlite_master
+        WHERE type = 'table'
+        AND name IN (?, ?)
+    """, (DAILY_USER_TABLE, DAILY_ITEM_TABLE)).fetchone()[0]
+    if tables_exist:
+        return
+    
+    pb_db_cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DAILY_USER_TABLE} (
+            Day          TEXT NOT NULL,
+            UserId       TEXT NOT NULL,
+            PlayCount    INTEGER NOT NULL,
+            PlayDuration INTEGER NOT NULL,
+            PRIMARY KEY (Day, UserId)
+        ) WITHOUT ROWID
+    """)
+    pb_db_cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DAILY_ITEM_TABLE} (
+            Day          TEXT NOT NULL,
+            ItemId       TEXT NOT NULL,
+            ItemType     TEXT,
+            ItemName     TEXT,
+            PlayCount    INTEGER NOT NULL,
+            PlayDuration INTEGER NOT NULL,
+            PRIMARY KEY (Day, ItemId)
+        ) WITHOUT ROWID
+    """)
+    folded_activity_rowcount = update_daily_totals(pb_db_cur, f"NOT {RAW_ACTIVITY_CONDITION}")
+    LOG.info("created the daily totals with %s already compressed activities", folded_activity_rowcount)
+
+
+def update_daily_totals(
+        pb_db_cur: sqlite3.Cursor,
+        condition: str,
+        parameters: tuple = (),
+    ) -> int:
+    """
+    adds the activities matching the condition to the per day totals of their user and item
+    
+    the compression calls this with the raw activities it is about to delete, in the same transaction, so every raw
+    activity is folded exactly once with its own day and its capped play duration, also if it was reported late with
+    an older DateCreated; compressed activities are not folded again when their bucket is compressed into a coarser one
+    
+    returns the number of folded activities
+    
+    note: this function does not automatically commits the updated totals
+    """
+    global METRICS
+    
+    # the AND true is required, so sqlite does not parse ON CONFLICT as a join constraint
+    with METRICS.timer("daily_totals"):
+        folded_activity_rowcount = pb_db_cur.execute(f"""
+            SELECT COUNT(*)
+            FROM PlaybackActivity
+            WHERE {condition}
+        """, parameters).fetchone()[0]
+        if folded_activity_rowcount == 0:
+            return 0
+        pb_db_cur.execute(f"""
+            INSERT INTO {DAILY_USER_TABLE}
+            SELECT substr(DateCreated, 1, 10), UserId, COUNT(*), SUM(PlayDuration)
+            FROM PlaybackActivity
+            WHERE {condition}
+            AND true
+            GROUP BY substr(DateCreated, 1, 10), UserId
+            ON CONFLICT (Day, UserId) DO UPDATE
+            SET PlayCount = PlayCount + excluded.PlayCount,
+                PlayDuration = PlayDuration + excluded.PlayDuration
+        """, parameters)
+        pb_db_cur.execute(f"""
+            INSERT INTO {DAILY_ITEM_TABLE}
+            SELECT substr(DateCreated, 1, 10), ItemId, MAX(ItemType), MAX(ItemName), COUNT(*), SUM(PlayDuration)
+            FROM PlaybackActivity
+            WHERE {condition}
+            AND true
+            GROUP BY substr(DateCreated, 1, 10), ItemId
+            ON CONFLICT (Day, ItemId) DO UPDATE
+            SET PlayCount = PlayCount + excluded.PlayCount,
+                PlayDuration = PlayDuration + excluded.PlayDuration
+        """, parameters)
+    METRICS.count("rows_daily_totals", folded_activity_rowcount)
+    
+    return folded_activity_rowcount
+
+
 def step_backwards(
         datetimes: list[dt.datetime],
         cursor: dt.datetime,
         _from: dt.datetime,
         step: str,
         count: int,
+        steps: Optional[list[str]] = None,
     ) -> dt.datetime:
     """
+    appends up to count datetime steps of the given step type to datetimes,
+    and the step type of each appended datetime to steps if given
     """
     global LOG
     
@@ -177,6 +1327,8 @@ def step_backwards(
 
         iterations += 1
     
+    if steps is not None:
+        steps.extend([step] * iterations)
     LOG.info("appended %s/%s datetime steps of 1%s length from %s to %s", iterations, count, step, datetimes[start_len], datetimes[-1])
     return cursor
 
@@ -184,9 +1336,11 @@ def get_datetime_ranges(
         retention: Retention,
         _from: dt.datetime,
         to: dt.datetime,
+        steps: Optional[list[str]] = None,
     ) -> list[dt.datetime]:
     """
-    creates a list of datetimes from latest to earliest, each datetime representing the start date of a retention period
+    creates a list of datetimes from latest to earliest, each datetime representing the start date of a retention period,
+    and fills steps with the step type of each datetime if given
     """
     global LOG
     
@@ -197,54 +1351,380 @@ def get_datetime_ranges(
     datetimes: list[dt.datetime] = []
     cursor: dt.datetime = to
 
-    cursor = step_backwards(datetimes, cursor, _from, "h", retention.hours)
-    cursor = step_backwards(datetimes, cursor, _from, "d", retention.days)
-    cursor = step_backwards(datetimes, cursor, _from, "w", retention.weeks)
-    cursor = step_backwards(datetimes, cursor, _from, "m", retention.months)
-    cursor = step_backwards(datetimes, cursor, _from, "y", retention.years)
+    cursor = step_backwards(datetimes, cursor, _from, "h", retention.hours, steps)
+    cursor = step_backwards(datetimes, cursor, _from, "d", retention.days, steps)
+    cursor = step_backwards(datetimes, cursor, _from, "w", retention.weeks, steps)
+    cursor = step_backwards(datetimes, cursor, _from, "m", retention.months, steps)
+    cursor = step_backwards(datetimes, cursor, _from, "y", retention.years, steps)
 
     return datetimes
 
+def get_datetime_buckets(
+        retention: Retention,
+        _from: dt.datetime,
+        to: dt.datetime,
+    ) -> list[Bucket]:
+    """
+    creates a list of retention buckets from latest to earliest, built from the datetime ranges of get_datetime_ranges
+    """
+    steps: list[str] = []
+    datetime_ranges = get_datetime_ranges(retention, _from, to, steps)
+    return [ (current, previous, step) for previous, current, step in zip(datetime_ranges, datetime_ranges[1:], steps[1:]) ]
 
-def main() -> NoReturn:
-    global CONFIG
 
-    # load playback activity and jellyfin databases and create cursors
-    # use sqlite3.Row instead of tuples for returns: https://docs.python.org/3/library/sqlite3.html#how-to-create-and-use-row-factories
-    pb_db_conn = sqlite3.connect(CONFIG.playback_activity_db)
-    pb_db_conn.row_factory = sqlite3.Row
-    pb_db_cur = pb_db_conn.cursor()
+def get_db_size(db: Path) -> int:
+    """
+    returns the size of the database file including its write-ahead log in bytes
+    """
+    wal = db.with_name(f"{db.name}-wal")
+    return db.stat().st_size + (wal.stat().st_size if wal.exists() else 0)
+
+
+def replace_with_vacuumed_copy(
+        pb_db: Path,
+        page_size: Optional[int] = None,
+    ) -> bool:
+    """
+    rebuilds the database into a compacted copy and atomically replaces the original with it, while an exclusive lock
+    on the original is held from before the copy until after the replace, so no write can get lost in between
+    
+    VACUUM INTO can not run inside a transaction, so the locked file is copied first and its copy is vacuumed into the
+    new file; a database in WAL mode is switched to the rollback journal first, which fails as long as any other
+    connection has it open
+    
+    the whole file is read once for the copy and written twice for the copy and the vacuumed file, so it costs about
+    three times the I/O of an in place VACUUM and the free disk space of two more copies of the database
+    
+    returns False if the lock can not be taken or copying or replacing the file fails, then the database is left as it
+    is, except that it may be in rollback journal mode; on windows it always returns False without touching the
+    database, because the file opened by sqlite can not be replaced and its locked bytes at 1 GiB can not be read
+    
+    note: a database in rollback journal mode, that is opened by another process without holding a lock, can not be
+    detected, because every open connection would keep writing to the replaced file
+    """
+    global LOG
+    
+    if os.name == "nt":
+        return False
+    
+    snapshot_db = pb_db.with_name(f"{pb_db.name}.snapshot")
+    vacuum_db = pb_db.with_name(f"{pb_db.name}.vacuum")
+    lock_conn = sqlite3.connect(pb_db, timeout=0, isolation_level=None)
+    try:
+        if lock_conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            lock_conn.execute("PRAGMA journal_mode = DELETE")
+        lock_conn.execute("BEGIN EXCLUSIVE")
+    except sqlite3.OperationalError as error:
+        lock_conn.close()
+        if is_busy_error(error):
+            return False
+        raise
+    
+    try:
+        shutil.copyfile(pb_db, snapshot_db)
+        snapshot_conn = sqlite3.connect(snapshot_db)
+        try:
+            if page_size is not None:
+                snapshot_conn.execute(f"PRAGMA page_size = {int(page_size)}")
+            vacuum_db.unlink(missing_ok=True)
+            snapshot_conn.execute("VACUUM INTO ?", (str(vacuum_db),))
+        finally:
+            snapshot_conn.close()
+            snapshot_db.unlink(missing_ok=True)
+        os.replace(vacuum_db, pb_db)
+        LOG.info("replaced %s with its vacuumed copy", pb_db)
+    except (OSError, sqlite3.OperationalError) as error:
+        LOG.warning("could not replace %s with its vacuumed copy: %s", pb_db, error)
+        return False
+    finally:
+        vacuum_db.unlink(missing_ok=True)
+        lock_conn.close()
+    return True
 
-    jf_db_conn = sqlite3.connect(CONFIG.jellyfin_db)
-    jf_db_conn.row_factory = sqlite3.Row
-    jf_db_cur = jf_db_conn.cursor()
+
+def reclaim_space(
+        pb_db: Path,
+        method: str,
+        page_size: Optional[int] = None,
+    ) -> tuple[int, int]:
+    """
+    shrinks the playback activity database file after compression and returns its size before and after in bytes
+    
+    'into' writes a compacted copy with VACUUM INTO next to the database and atomically replaces the original with it,
+    or falls back to an in place VACUUM if another connection holds a lock on it, the file can not be copied or replaced
+    or on windows, 'incremental' switches to auto_vacuum=INCREMENTAL, which requires one full VACUUM, and otherwise frees all unused
+    pages with incremental_vacuum
     
-    # cap playback duration of all entries to their specific runtime
-    cap_playduration(pb_db_cur, jf_db_cur)
-    pb_db_conn.commit()
+    note: there must be no open connection to the database
+    """
+    global LOG, METRICS
+    
+    bytes_before = get_db_size(pb_db)
+    pb_db_conn = sqlite3.connect(pb_db)
+    journal_mode = pb_db_conn.execute("PRAGMA journal_mode").fetchone()[0]
+    current_page_size = pb_db_conn.execute("PRAGMA page_size").fetchone()[0]
+    rebuild_page_size = page_size is not None and page_size != current_page_size
+    
+    with METRICS.timer("vacuum"):
+        if method == "into":
+            pb_db_conn.close()
+            if not replace_with_vacuumed_copy(pb_db, page_size):
+                LOG.warning("%s is opened by another process or can not be replaced, vacuum it in place instead", pb_db)
+                pb_db_conn = sqlite3.connect(pb_db)
+                # the page size of a database in WAL mode can not be changed
+                in_wal_mode = pb_db_conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+                if rebuild_page_size and not in_wal_mode:
+                    pb_db_conn.execute(f"PRAGMA page_size = {int(page_size)}")
+                pb_db_conn.execute("VACUUM")
+                if in_wal_mode:
+                    pb_db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                pb_db_conn.close()
+        
+            # the copy is always created in rollback journal mode, and the original may have been switched to it
+            if journal_mode == "wal":
+                pb_db_conn = sqlite3.connect(pb_db)
+                pb_db_conn.execute("PRAGMA journal_mode = WAL")
+                pb_db_conn.close()
+    
+        elif method == "incremental":
+            auto_vacuum = pb_db_conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        
+            if auto_vacuum != 2 or rebuild_page_size:
+                LOG.info("rebuild database once to enable incremental auto vacuum with page size %s", page_size or current_page_size)
+                # the page size of a database in WAL mode can not be changed
+                if rebuild_page_size and journal_mode == "wal":
+                    pb_db_conn.execute("PRAGMA journal_mode = DELETE")
+                    pb_db_conn.execute(f"PRAGMA page_size = {int(page_size)}")
+                elif rebuild_page_size:
+                    pb_db_conn.execute(f"PRAGMA page_size = {int(page_size)}")
+                pb_db_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                pb_db_conn.execute("VACUUM")
+                if journal_mode == "wal":
+                    pb_db_conn.execute("PRAGMA journal_mode = WAL")
+        
+            else:
+                freelist_count = pb_db_conn.execute("PRAGMA freelist_count").fetchone()[0]
+                pb_db_conn.execute("PRAGMA incremental_vacuum").fetchall()
+                LOG.info("freed %s unused pages", freelist_count)
+        
+            if journal_mode == "wal":
+                pb_db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            pb_db_conn.close()
+    
+        else:
+            pb_db_conn.close()
+            raise ValueError(f"unknown vacuum method '{method}'")
     
-    #
+    bytes_after = get_db_size(pb_db)
+    LOG.info("reclaimed %s bytes with %s vacuum: %s -> %s bytes", bytes_before - bytes_after, method, bytes_before, bytes_after)
+    return bytes_before, bytes_after
+
+
+def get_activity_buckets(
+        pb_db_cur: sqlite3.Cursor,
+        retention: Retention,
+    ) -> tuple[list[Bucket], dt.datetime]:
+    """
+    creates the retention buckets for all playback activity and returns them with the latest activity datetime
+    """
+    # MIN/MAX of the bare column are answered directly from the index
     minmax_datetime = pb_db_cur.execute("""
-        SELECT MIN(datetime(DateCreated)) AS MinDateCreated, MAX(datetime(DateCreated)) AS MaxDateCreated
+        SELECT datetime(MIN(DateCreated)) AS MinDateCreated, datetime(MAX(DateCreated)) AS MaxDateCreated
         FROM PlaybackActivity
     """).fetchone()
     min_datetime = dt.datetime.fromisoformat(minmax_datetime["MinDateCreated"])
     max_datetime = dt.datetime.fromisoformat(minmax_datetime["MaxDateCreated"])
     
-    datetime_ranges = get_datetime_ranges(CONFIG.retention, min_datetime, max_datetime)
+    return get_datetime_buckets(retention, min_datetime, max_datetime), max_datetime
+
+
+def main() -> NoReturn:
+    global CONFIG, METRICS
     
-    for idx, current in enumerate(datetime_ranges[1:]):
-        previous = datetime_ranges[idx]
+    # only read the playback activity database to print what a compression would do
+    if CONFIG.plan:
+        pb_db_conn = sqlite3.connect(f"{CONFIG.playback_activity_db.absolute().as_uri()}?mode=ro", uri=True)
+        pb_db_conn.row_factory = sqlite3.Row
+        pb_db_cur = pb_db_conn.cursor()
         
-        #
-        compress_activity_range(pb_db_cur, current, previous)
+        buckets, _ = get_activity_buckets(pb_db_cur, CONFIG.retention)
+        print_plan(plan_compression(pb_db_cur, buckets), CONFIG.plan_format)
+        
+        pb_db_conn.close()
+        return
+
+    # load playback activity and jellyfin databases and create cursors
+    # use sqlite3.Row instead of tuples for returns: https://docs.python.org/3/library/sqlite3.html#how-to-create-and-use-row-factories
+    # uri=True allows to attach the jellyfin database read-only
+    started = time.perf_counter()
+    pb_db_conn = sqlite3.connect(CONFIG.playback_activity_db, uri=True)
+    pb_db_conn.row_factory = sqlite3.Row
+    pb_db_cur = pb_db_conn.cursor()
+    
+    if CONFIG.online:
+        enable_online_mode(pb_db_cur, CONFIG.busy_timeout_ms)
+    
+    # cap playback duration of all entries to their specific runtime,
+    # the online mode takes precedence, because the other ways cap all entries in one transaction
+    if CONFIG.online:
+        jf_db_conn = sqlite3.connect(f"{CONFIG.jellyfin_db.absolute().as_uri()}?mode=ro", uri=True)
+        jf_db_conn.row_factory = sqlite3.Row
+        cap_playduration_online(pb_db_cur, jf_db_conn.cursor(), CONFIG.batch_size, CONFIG.max_retries, CONFIG.retry_backoff_sec)
+        jf_db_conn.close()
+    
+    elif CONFIG.cap_via_attach:
+        attach_jellyfin_db(pb_db_cur, CONFIG.jellyfin_db)
+        cap_playduration_attached(pb_db_cur)
+        with METRICS.timer("commit"):
+            pb_db_conn.commit()
+        pb_db_cur.execute("DETACH DATABASE jf")
+    
+    else:
+        jf_db_conn = sqlite3.connect(CONFIG.jellyfin_db)
+        jf_db_conn.row_factory = sqlite3.Row
+        jf_db_cur = jf_db_conn.cursor()
+        
+        if CONFIG.streaming:
+            cap_playduration_streaming(pb_db_cur, jf_db_cur, CONFIG.batch_size)
+        else:
+            cap_playduration(pb_db_cur, jf_db_cur, CONFIG.log_sample_every)
+        with METRICS.timer("commit"):
+            pb_db_conn.commit()
+        jf_db_conn.close()
+    
+    # make sure the range predicates below are served by an index,
+    # creating it and seeding the daily totals below hold the write lock once for a scan of the whole table
+    if CONFIG.online:
+        if not table_or_index_exists(pb_db_cur, "index", DATECREATED_INDEX):
+            LOG.warning("creating index %s holds the write lock once for the whole table", DATECREATED_INDEX)
+        run_write_transaction(pb_db_cur, ensure_datecreated_index, CONFIG.max_retries, CONFIG.retry_backoff_sec)
+    else:
+        ensure_datecreated_index(pb_db_cur)
+        pb_db_conn.commit()
+    explain_query_plan(pb_db_cur, """
+        SELECT UserId, ItemId, SUM(PlayDuration)
+        FROM PlaybackActivity
+        WHERE DateCreated >= ?
+        AND DateCreated < ?
+        GROUP BY UserId, ItemId
+    """, ("", ""), "bucket_select")
+    explain_query_plan(pb_db_cur, """
+        DELETE
+        FROM PlaybackActivity
+        WHERE DateCreated >= ?
+        AND DateCreated < ?
+    """, ("", ""), "bucket_delete")
+    
+    # the raw activities are folded into the daily totals by the compression, before their dates are lost
+    if CONFIG.daily_totals and CONFIG.online:
+        if not table_or_index_exists(pb_db_cur, "table", DAILY_USER_TABLE) or not table_or_index_exists(pb_db_cur, "table", DAILY_ITEM_TABLE):
+            LOG.warning("seeding the daily totals holds the write lock once for the whole table")
+        run_write_transaction(pb_db_cur, ensure_daily_totals_tables, CONFIG.max_retries, CONFIG.retry_backoff_sec)
+    elif CONFIG.daily_totals:
+        ensure_daily_totals_tables(pb_db_cur)
+        pb_db_conn.commit()
+    
+    with METRICS.timer("range_planning"):
+        buckets, max_datetime = get_activity_buckets(pb_db_cur, CONFIG.retention)
+        METRICS.count("buckets_total", len(buckets))
+        
+        # only compress buckets that changed since the last run
+        pending_buckets = buckets
+        if CONFIG.incremental:
+            ensure_watermark_table(pb_db_cur)
+            pb_db_conn.commit()
+            pending_buckets = filter_compressed_buckets(pb_db_cur, buckets)
+            METRICS.count("buckets_skipped_watermark", len(buckets) - len(pending_buckets))
+    
+    # the online mode takes precedence, because a rollup replaces all buckets in one transaction
+    rollup = CONFIG.rollup and not CONFIG.online
+    
+    # rewriting an already compact bucket would not change anything, the rollup checks all buckets in one statement
+    if CONFIG.skip_compact and not rollup:
+        compact_bucket_count = len(pending_buckets)
+        pending_buckets = [ (_from, to, step) for _from, to, step in pending_buckets if not is_bucket_compact(pb_db_cur, _from, to) ]
+        compact_bucket_count -= len(pending_buckets)
+        LOG.info("skipped %s already compact buckets and rewrite %s buckets", compact_bucket_count, len(pending_buckets))
+        METRICS.count("buckets_skipped_compact", compact_bucket_count)
+    
+    # keep the raw activities before they are deleted, with one part file per month for all buckets
+    if CONFIG.archive_dir is not None:
+        with ActivityArchive(CONFIG.archive_dir) as archive:
+            for _from, to, _ in pending_buckets:
+                archive_activity_range(pb_db_cur, _from, to, archive, CONFIG.batch_size)
+    
+    if rollup:
+        compress_activity_rollup(pb_db_cur, pending_buckets, CONFIG.skip_compact, CONFIG.daily_totals)
+        with METRICS.timer("commit"):
+            pb_db_conn.commit()
+    
+    elif CONFIG.online:
+        for _from, to, _ in pending_buckets:
+            compress_activity_range_online(pb_db_cur, _from, to, CONFIG.batch_size, CONFIG.max_retries, CONFIG.retry_backoff_sec, CONFIG.daily_totals)
+            METRICS.count("buckets_rewritten")
+    
+    else:
+        for _from, to, _ in pending_buckets:
+            if CONFIG.streaming:
+                compress_activity_range_streaming(pb_db_cur, _from, to, CONFIG.batch_size, CONFIG.daily_totals)
+            else:
+                compress_activity_range(pb_db_cur, _from, to, CONFIG.daily_totals)
+            with METRICS.timer("commit"):
+                pb_db_conn.commit()
+            METRICS.count("buckets_rewritten")
+    
+    if CONFIG.incremental:
+        store_watermark(pb_db_cur, buckets, max_datetime)
         pb_db_conn.commit()
 
-    # close all loaded databases
+    # close all loaded databases, the cursor first, because an unfinished statement keeps the file open
+    pb_db_cur.close()
     pb_db_conn.close()
-    jf_db_conn.close()
+    
+    # shrink the database file by the space of the deleted activities
+    if CONFIG.vacuum is not None:
+        bytes_before, bytes_after = reclaim_space(CONFIG.playback_activity_db, CONFIG.vacuum, CONFIG.page_size)
+        METRICS.count("bytes_reclaimed", bytes_before - bytes_after)
+    
+    METRICS.record("total", time.perf_counter() - started)
+    LOG.info("phase timings: %s", pformat(METRICS.phases))
+    
+    if (peak_rss := get_peak_rss()) is not None:
+        LOG.info("peak resident set size: %.1f MiB", peak_rss / 1024**2)
+    else:
+        LOG.info("peak resident set size not available, install psutil")
+    
+    # one json line per run, so runs on different hardware or database sizes can be compared
+    if CONFIG.metrics_file is not None:
+        METRICS.write(CONFIG.metrics_file, config=asdict(CONFIG), peak_rss_bytes=peak_rss)
+        LOG.info("wrote metrics to %s", CONFIG.metrics_file)
 
 
 
 if __name__ == "__main__":
+    _parser = argparse.ArgumentParser(description="Caps and compresses the playback activity of the Jellyfin Playback Reporting plugin according to a retention policy.")
+    _parser.add_argument("--playback-db", type=Path, default=CONFIG.playback_activity_db, dest="playback_activity_db", help="path to the playback reporting database (default: %(default)s)")
+    _parser.add_argument("--jellyfin-db", type=Path, default=CONFIG.jellyfin_db, dest="jellyfin_db", help="path to the jellyfin database (default: %(default)s)")
+    _parser.add_argument("--rollup", action="store_true", default=CONFIG.rollup, help="compress all buckets with one GROUP BY")
+    _parser.add_argument("--cap-via-attach", action="store_true", default=CONFIG.cap_via_attach, dest="cap_via_attach", help="cap playback durations with one UPDATE against the attached jellyfin database")
+    _parser.add_argument("--incremental", action="store_true", default=CONFIG.incremental, help="skip buckets that are already compressed according to the watermark")
+    _parser.add_argument("--streaming", action="store_true", default=CONFIG.streaming, help="read and write large queries in batches")
+    _parser.add_argument("--batch-size", type=int, default=CONFIG.batch_size, dest="batch_size", help="rows per batch in streaming mode and capped entries or groups per transaction in online mode (default: %(default)s)")
+    _parser.add_argument("--online", action="store_true", default=CONFIG.online, help="use WAL and short transactions to compress while jellyfin is running")
+    _parser.add_argument("--plan", action="store_true", default=CONFIG.plan, help="only print the row counts per bucket before and after compression")
+    _parser.add_argument("--plan-format", choices=["table", "json"], default=CONFIG.plan_format, dest="plan_format", help="output format of --plan (default: %(default)s)")
+    _parser.add_argument("--archive-dir", type=Path, default=CONFIG.archive_dir, dest="archive_dir", help="archive the raw activities into monthly partitions of this folder before deleting them")
+    _parser.add_argument("--rewrite-compact", action="store_false", default=CONFIG.skip_compact, dest="skip_compact", help="also rewrite buckets that are already compact")
+    _parser.add_argument("--vacuum", choices=["into", "incremental"], default=CONFIG.vacuum, help="reclaim the space of the deleted activities after compression")
+    _parser.add_argument("--page-size", type=int, default=CONFIG.page_size, dest="page_size", help="page size in bytes to rebuild the database with (default: keep current)")
+    _parser.add_argument("--daily-totals", action="store_true", default=CONFIG.daily_totals, dest="daily_totals", help="maintain the per day totals of every user and item in side tables")
+    _parser.add_argument("--metrics-file", type=Path, default=CONFIG.metrics_file, dest="metrics_file", help="append the phase timings, counters and query plans of this run as one json line to this file")
+    _parser.add_argument("--log-sample-every", type=int, default=CONFIG.log_sample_every, dest="log_sample_every", help="log only every n-th capped activity (default: %(default)s)")
+    _args = _parser.parse_args()
+    
+    if _args.log_sample_every < 1:
+        _parser.error("--log-sample-every must be at least 1")
+    
+    for key, value in vars(_args).items():
+        setattr(CONFIG, key, value)
     main()
@@ -39,12 +39,20 @@ and add instead all local trailers, that are present in each movie folder.
 
 You can add labels to movies by putting them in square brackets in the movie filename. With this option, all these
 labels from the filename are added to the tags listed in the movie.nfo file.
+
+
+The state of the library after each run is stored in the manifest file set by _manifest_path. The next run only
+processes the movies whose folder, NFO or trailers changed since then, and movies with a new trailer.
 """
 
 import os
+import copy
 from pathlib import Path
 import xml.etree.ElementTree as ET
-from typing import Optional
+from typing import Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+import hashlib
 import subprocess
 import shutil
 import json
@@ -69,6 +77,18 @@ _add_new_trailers = False
 _link_local_trailers = True
 _update_tags_by_filename = True
 
+# number of movie folders processed at the same time, which mostly hides the latency of a network share,
+# the log of each folder is still printed as one block in library order
+_workers = 8
+
+# the state of every folder at the last sync, later runs only list the folders whose mtime changed and only process
+# the movies whose folder, NFO or trailers changed since, set it to None to always process the whole library;
+# it is stored next to this script and not in the library, so jellyfin never scans it and the library root keeps its
+# mtime, and each _base_path gets its own manifest
+_manifest_path: Optional[str] = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    ".update-trailers." + hashlib.sha1(_base_path.encode("utf-8")).hexdigest()[:12] + ".manifest.json",
+)
 
 
 def backup_nfo(nfo_path: str) -> None:
@@ -78,59 +98,348 @@ def backup_nfo(nfo_path: str) -> None:
         print(f"Backup created: {backup_path}")
 
 
-def update_nfo_with_trailers(nfo_path: str, trailer_paths: list[str]) -> None:
-    try:
-        tree = ET.parse(nfo_path)
-        root = tree.getroot()
-
-        for trailer in root.findall("trailer"):
-            if trailer.text.startswith("plugin://"):
-                root.remove(trailer)
-                print(f"remote trailer removed: {trailer.text}")
+class NfoTransaction:
+    """
+    parses a NFO file once, applies all updates to the parsed tree and writes it at most once when the transaction
+    ends without an error, so each movie costs one read and one write over the network share
+
+    the file is only written if the updated document differs from the original one after indenting both, so unchanged
+    NFOs keep their mtime and jellyfin does not re-read their metadata
+    """
+
+    def __init__(self, nfo_path: str, log: Callable[[str], None] = print) -> None:
+        self.nfo_path = nfo_path
+        self.log = log
+        self.tree: Optional[ET.ElementTree] = None
+        self.modified = False
+        self.written = False
+        self.__original: Optional[str] = None
+
+    def __enter__(self) -> "NfoTransaction":
+        self.tree = ET.parse(self.nfo_path)
+        self.__original = self.canonical()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None and self.modified:
+            if self.canonical() != self.__original:
+                self.write()
+            else:
+                self.log(f"Unchanged {self.nfo_path}")
+
+    def canonical(self) -> str:
+        # formatting differences like the indentation or the xml declaration do not count as change
+        root = copy.deepcopy(self.root)
+        ET.indent(root, space="  ", level=0)
+        return ET.tostring(root, encoding="unicode")
+
+    @property
+    def root(self) -> ET.Element:
+        return self.tree.getroot()
+
+    def replace_elements(self, name: str, texts: list[str]) -> list[str]:
+        # the new elements take the place of the first old one, so the layout jellyfin wrote is kept
+        root = self.root
+        old_elements = root.findall(name)
+        index = list(root).index(old_elements[0]) if old_elements else len(root)
+        for element in old_elements:
+            root.remove(element)
+        for offset, text in enumerate(texts):
+            element = ET.Element(name)
+            element.text = text
+            root.insert(index + offset, element)
+        self.modified = True
+        return [ element.text or "" for element in old_elements ]
+
+    def replace_trailers(self, trailer_paths: list[str]) -> None:
+        new_trailers = [ trailer_path.replace(_base_path, _jellyfin_base_path).replace("\\", "/") for trailer_path in sorted(trailer_paths) ]
+        # the order of the trailers in the NFO does not matter, so the same trailers in another order are no change
+        if sorted( trailer.text or "" for trailer in self.root.findall("trailer") ) == sorted(new_trailers):
+            return
+
+        for old_trailer in self.replace_elements("trailer", new_trailers):
+            if old_trailer.startswith("plugin://"):
+                self.log(f"remote trailer removed: {old_trailer}")
             else:
-                root.remove(trailer)
-                print(f"trailer removed: {trailer.text}")
+                self.log(f"trailer removed: {old_trailer}")
+        for trailer_path in sorted(trailer_paths):
+            self.log(f"local trailer added: {trailer_path}")
 
-        for trailer_path in trailer_paths:
-            trailer_elem = ET.Element("trailer")
-            trailer_elem.text = trailer_path.replace(_base_path, _jellyfin_base_path).replace("\\", "/")
-            root.append(trailer_elem)
-            print(f"local trailer added: {trailer_path}")
+    def update_tags(self, new_tags: set[str], *, extend_tags: bool = True) -> None:
+        all_tags = set([ tag.lower() for tag in new_tags ])
+        if extend_tags:
+            all_tags |= set([ (tag.text or "").lower() for tag in self.root.findall("tag") ])
+        # the tags are compared as set, so only a missing, an additional or a not lowercase tag is a change
+        if sorted( tag.text or "" for tag in self.root.findall("tag") ) == sorted(all_tags):
+            return
+
+        # sorted, because the order of a set changes between runs
+        for old_tag in self.replace_elements("tag", sorted(all_tags)):
+            self.log(f"tag removed: {old_tag}")
+        for tag in sorted(all_tags):
+            self.log(f"tag added: {tag}")
+
+    def write(self) -> None:
+        ET.indent(self.tree, space="  ", level=0)
+        self.tree.write(self.nfo_path, encoding="utf-8", xml_declaration=True)
+        self.modified = False
+        self.written = True
+        self.log(f"Updated {self.nfo_path}")
+
+
+# the year in a movie name like 'Movie (2020)', which is used as index key to match trailers
+_year_pattern = re.compile(r"\(\d{4}\)")
+
+
+def match_trailers(movie_folders: list[str], trailer_paths: list[str]) -> tuple[dict[str, str], dict[str, list[str]], list[str], list[str]]:
+    """
+    assigns every trailer to the movie folder whose lowercase name is contained in the lowercase trailer filename,
+    if several names are contained the longest one wins, and every movie gets at most its first trailer
+
+    the movie names are indexed by their year, so each trailer is only compared to the movies of the years in its
+    filename and to the few movies without year
+
+    returns the trailer of every matched movie folder, the candidate names of every ambiguous trailer, the trailers
+    without any matching movie and the trailers not used because their movie already has one
+    """
+    folders_by_name: dict[str, list[str]] = {}
+    for folder in movie_folders:
+        folders_by_name.setdefault(os.path.basename(folder).lower(), []).append(folder)
+    names_by_year: dict[str, list[str]] = {}
+    names_without_year: list[str] = []
+    for name in folders_by_name:
+        if years := _year_pattern.findall(name):
+            names_by_year.setdefault(years[-1], []).append(name)
+        else:
+            names_without_year.append(name)
+
+    assigned: dict[str, str] = {}
+    ambiguous: dict[str, list[str]] = {}
+    unmatched: list[str] = []
+    unused: list[str] = []
+    for trailer_path in sorted(trailer_paths):
+        filename = os.path.basename(trailer_path).lower()
+        candidates = [ name for year in set(_year_pattern.findall(filename)) for name in names_by_year.get(year, []) if name in filename ]
+        candidates.extend( name for name in names_without_year if name in filename )
+        if not candidates:
+            unmatched.append(trailer_path)
+            continue
+        if len(candidates) > 1:
+            ambiguous[trailer_path] = sorted(candidates)
+
+        # movie folders with the same name get the trailers one after another
+        folders = [ folder for folder in folders_by_name[max(candidates, key=len)] if folder not in assigned ]
+        if folders:
+            assigned[folders[0]] = trailer_path
+        else:
+            unused.append(trailer_path)
+
+    return assigned, ambiguous, unmatched, unused
+
+
+def process_movie_folder(root: str, files: list[str], found_movie_trailer: Optional[str] = None) -> tuple[Optional[str], list[str]]:
+    """
+    applies all enabled updates to the NFO of one movie folder
+
+    returns 'changed', 'untouched', 'failed' or None if nothing had to be done, and the log lines of the folder, which
+    are collected instead of printed, so parallel folders do not mix their output; any error only fails this folder
+    """
+    lines: list[str] = []
+    log = lines.append
+    
+    if "season.nfo" in files:
+        nfo_path = os.path.join(root, "season.nfo")
+    else:
+        nfo_path = os.path.join(root, "movie.nfo")
+    
+    movie_name = os.path.basename(root)
+    log(f"\nMovie: {movie_name}")
+    
+    try:
+        # collect all updates of this NFO, so it is parsed and written only once
+        trailer_updates: list[list[str]] = []
+        
+        if _add_new_trailers:
+            if found_movie_trailer is None:
+                return None, lines
+            log(f"found movie trailer: {found_movie_trailer}")
+        
+            # backup_nfo(nfo_path)
+            #OR:
+            # nfo_backup_path = nfo_path.replace("movie.nfo", "movie.nfo.backup")
+            # if os.path.exists(nfo_backup_path):
+            #     os.remove(nfo_backup_path)
+            #     print("removed backup-nfo")
+
+            trailers_folder = os.path.join(root, "trailers")
+            os.makedirs(trailers_folder, exist_ok=True)
+            #OR:
+            # if os.path.exists(trailers_folder):
+            #     shutil.rmtree(trailers_folder)
+            #     continue
+
+            path_at_share = os.path.join(root, "trailers", os.path.basename(found_movie_trailer))
+            shutil.copyfile(found_movie_trailer, path_at_share)
+            trailer_updates.append([path_at_share])
+        
+        if _link_local_trailers:
+            trailers_folder = os.path.join(root, "trailers")
+            if os.path.exists(trailers_folder):
+                local_trailers = [ os.path.join(trailers_folder, trailer_path) for trailer_path in os.listdir(trailers_folder) ]
+                trailer_updates.append(local_trailers)
+        
+        tag_updates: list[set[str]] = []
+        if _update_tags_by_filename:
+            movie_files = [ file for file in files if file.rsplit(".", 1)[-1] in {"mp4", "mkv"} ]
+            for movie_file in movie_files:
+                file_tags = re.findall(r"\[([^\[\]]+)\]", movie_file)
+                tag_updates.append(set(file_tags))
+        
+        if not trailer_updates and not tag_updates:
+            return None, lines
+        with NfoTransaction(nfo_path, log) as nfo:
+            for trailer_paths in trailer_updates:
+                nfo.replace_trailers(trailer_paths)
+            for file_tags in tag_updates:
+                nfo.update_tags(file_tags, extend_tags=True)
+        return "changed" if nfo.written else "untouched", lines
+    
+    except ET.ParseError as e:
+        log(f"Error updating {nfo_path}: {e}")
+        return "failed", lines
+    except Exception:
+        log(f"Error updating {nfo_path}:\n{traceback.format_exc().rstrip()}")
+        return "failed", lines
+
+
+def listing_hash(names: list[str]) -> str:
+    return hashlib.sha1("\n".join(sorted(names)).encode("utf-8")).hexdigest()
+
+
+def list_folder(path: str) -> tuple[list[str], dict[str, int]]:
+    """
+    lists the files of a folder and the mtimes of its subfolders with a single scandir call
+    """
+    files: list[str] = []
+    dirs: dict[str, int] = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # on windows the stat result comes with the listing, so this costs no extra request to the share
+                dirs[entry.name] = entry.stat(follow_symlinks=False).st_mtime_ns
+            else:
+                files.append(entry.name)
+    return sorted(files), dirs
 
-        ET.indent(tree, space="  ", level=0)
-        tree.write(nfo_path, encoding="utf-8", xml_declaration=True)
-        print(f"Updated {nfo_path}")
 
-    except ET.ParseError as e:
-        print(f"Error updating {nfo_path}: {e}")
+def folder_entry(mtime_ns: int, files: list[str], dirs: dict[str, int]) -> dict:
+    entry = {"mtime_ns": mtime_ns, "files_hash": listing_hash(files), "dirs": sorted(dirs)}
+    if "season.nfo" in files:
+        entry["nfo"] = "season.nfo"
+    elif "movie.nfo" in files:
+        entry["nfo"] = "movie.nfo"
+    return entry
 
 
-def update_nfo_with_tags(nfo_path: str, new_tags: set[str], *, extend_tags: bool = True) -> None:
+def load_manifest(manifest_path: Optional[str]) -> dict:
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {}
     try:
-        tree = ET.parse(nfo_path)
-        root = tree.getroot()
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Error reading manifest {manifest_path}, processing the whole library: {e}")
+        return {}
 
-        all_tags = set([ tag.lower() for tag in new_tags ])
-        if extend_tags:
-            all_tags |= set([ tag.text.lower() for tag in root.findall("tag") ])
 
-        for tag in root.findall("tag"):
-            root.remove(tag)
-            print(f"tag removed: {tag.text}")
+def save_manifest(manifest_path: str, manifest: dict) -> None:
+    # replaced at once, so an interrupted run never leaves a truncated manifest behind
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file)
+    os.replace(temporary_path, manifest_path)
 
-        for tag in all_tags:
-            tag_elem = ET.Element("tag")
-            tag_elem.text = tag
-            root.append(tag_elem)
-            print(f"tag added: {tag_elem.text}")
 
-        ET.indent(tree, space="  ", level=0)
-        tree.write(nfo_path, encoding="utf-8", xml_declaration=True)
-        print(f"Updated {nfo_path}")
-
-    except ET.ParseError as e:
-        print(f"Error updating {nfo_path}: {e}")
+def scan_folder(path: str, mtime_ns: int, recorded: Optional[dict]) -> Optional[tuple[dict, dict[str, int], Optional[list[str]]]]:
+    """
+    returns the new manifest entry of a folder, the mtimes of its subfolders and its files if it had to be listed,
+    or None if it can not be listed
 
+    a folder whose mtime is the recorded one is not listed again, only if it has subfolders their mtimes are read from
+    one scandir of it, which on windows costs a single request to the share for all of them
+    """
+    try:
+        if recorded is not None and recorded["mtime_ns"] == mtime_ns:
+            dirs = list_folder(path)[1] if recorded["dirs"] else {}
+            return dict(recorded), dirs, None
+        files, dirs = list_folder(path)
+    except OSError:
+        return None
+    entry = folder_entry(mtime_ns, files, dirs)
+    if recorded is not None and "synced" in recorded:
+        entry["synced"] = recorded["synced"]
+    return entry, dirs, files
+
+
+def scan_library(base_path: str, recorded_folders: dict[str, dict], workers: int = 1) -> tuple[dict[str, dict], dict[str, list[str]]]:
+    """
+    walks the library like os.walk, but only lists the folders whose mtime differs from the one recorded in the
+    manifest, the subfolders of all other folders are taken from the manifest, so an unchanged folder without
+    subfolders costs no request at all
+
+    the mtime of a folder only changes if one of its own entries is added, removed or renamed, so every folder is
+    still visited, but none is listed and no NFO is parsed on an unchanged library; the folders of each level of the
+    library are scanned by a pool of workers, which mostly hides the latency of a network share
+
+    returns the new manifest entry of every folder and the files of every folder that had to be listed
+    """
+    folders: dict[str, dict] = {}
+    listed_files: dict[str, list[str]] = {}
+    pending = [ (base_path, os.stat(base_path).st_mtime_ns) ]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while pending:
+            results = executor.map(lambda folder: scan_folder(*folder, recorded_folders.get(folder[0])), pending)
+            next_pending: list[tuple[str, int]] = []
+            for (path, _), result in zip(pending, results):
+                # like os.walk, folders that can not be listed are skipped
+                if result is None:
+                    continue
+                entry, dirs, files = result
+                folders[path] = entry
+                if files is not None:
+                    listed_files[path] = files
+                next_pending.extend( (os.path.join(path, name), dir_mtime_ns) for name, dir_mtime_ns in dirs.items() )
+            pending = next_pending
+    return folders, listed_files
+
+
+def sync_state(root: str, folders: dict[str, dict]) -> Optional[dict]:
+    """
+    the state of a movie folder that is compared with the manifest: its file listing, the mtime of its NFO, which
+    jellyfin rewrites in place when it refreshes the metadata, and the listing of its trailers folder
+    """
+    entry = folders[root]
+    try:
+        nfo_mtime_ns = os.stat(os.path.join(root, entry["nfo"])).st_mtime_ns
+    except OSError:
+        return None
+    trailers_entry = folders.get(os.path.join(root, "trailers"), {})
+    return {"files_hash": entry["files_hash"], "nfo_mtime_ns": nfo_mtime_ns, "trailers_hash": trailers_entry.get("files_hash")}
+
+
+def rescan_movie_folder(root: str) -> dict[str, dict]:
+    """
+    returns the manifest entries of a movie folder and its trailers folder after it was processed, because copying a
+    new trailer or writing the NFO changes them
+    """
+    folders: dict[str, dict] = {}
+    files, dirs = list_folder(root)
+    folders[root] = folder_entry(os.stat(root).st_mtime_ns, files, dirs)
+    if "trailers" in dirs:
+        trailers_folder = os.path.join(root, "trailers")
+        folders[trailers_folder] = folder_entry(dirs["trailers"], *list_folder(trailers_folder))
+    folders[root]["synced"] = sync_state(root, folders)
+    return folders
 
 
 def main() -> None:
@@ -141,66 +450,69 @@ def main() -> None:
             if os.path.isfile(merged_path) and path.endswith(".mp4"):
                 new_trailers_paths.append(merged_path)
     new_trailers_paths.sort()
-
-
-    for ind, (root, dirs, files) in enumerate(sorted(os.walk(_base_path))):
-        # if not ("_Serien" in root):
-            # print("not in list")
-            # continue
+    
+    # how many NFOs were written, left untouched because nothing changed, or could not be parsed or updated
+    counts = {"changed": 0, "untouched": 0, "failed": 0}
+    movie_trailers: dict[str, str] = {}
+
+    # the synced state of the folders is only valid as long as the options that change the NFOs are the same
+    options = {"jellyfin_base_path": _jellyfin_base_path, "link_local_trailers": _link_local_trailers, "update_tags_by_filename": _update_tags_by_filename}
+    manifest = load_manifest(_manifest_path)
+    recorded_folders = manifest.get("folders", {}) if manifest.get("options") == options else {}
+    folders, listed_files = scan_library(_base_path, recorded_folders, _workers)
+    movie_folders = sorted( root for root, entry in folders.items() if "nfo" in entry )
+    
+    # match all new trailers at once, before any folder is processed
+    if _add_new_trailers:
+        movie_trailers, ambiguous_trailers, unmatched_trailers, unused_trailers = match_trailers(movie_folders, new_trailers_paths)
+        print(f"matched {len(movie_trailers)} of {len(new_trailers_paths)} new trailers")
+        for trailer_path, movie_names in ambiguous_trailers.items():
+            print(f"ambiguous trailer: {trailer_path} matches {movie_names}")
+        for trailer_path in unmatched_trailers:
+            print(f"unmatched trailer: {trailer_path}")
+        for trailer_path in unused_trailers:
+            print(f"unused trailer, its movie already has one: {trailer_path}")
+
+    def is_changed(root: str) -> bool:
+        # a movie with a new trailer is always processed, all others only if they changed since the last sync
+        return root in movie_trailers or "synced" not in folders[root] or folders[root]["synced"] != sync_state(root, folders)
+    
+    def process(root: str) -> tuple[Optional[str], list[str], Optional[dict[str, dict]]]:
+        try:
+            files = listed_files[root] if root in listed_files else list_folder(root)[0]
+        except OSError as e:
+            return "failed", [f"\nMovie: {os.path.basename(root)}", f"Error listing {root}: {e}"], None
+        status, lines = process_movie_folder(root, files, movie_trailers.get(root))
+        # failed movies and movies skipped because no new trailer was found for them have to be processed again
+        if _manifest_path is None or status == "failed" or (_add_new_trailers and root not in movie_trailers):
+            return status, lines, None
+        try:
+            return status, lines, rescan_movie_folder(root)
+        except OSError:
+            return status, lines, None
+    
+    with ThreadPoolExecutor(max_workers=max(1, _workers)) as executor:
+        if _manifest_path is None:
+            changed_folders = movie_folders
+        else:
+            # the NFO of every movie is checked in the pool as well, because each check is a request to the share
+            changed_folders = [ root for root, changed in zip(movie_folders, executor.map(is_changed, movie_folders)) if changed ]
+            print(f"{len(changed_folders)} of {len(movie_folders)} movie folders changed since the last sync")
         
-        # if ind > 2:
-        #     print("early exit")
-        #     break
-            
-        if "movie.nfo" in files or "season.nfo" in files:
-
-            if "season.nfo" in files:
-                nfo_path = os.path.join(root, "season.nfo")
-            elif "movie.nfo" in files:
-                nfo_path = os.path.join(root, "movie.nfo")
-            
-            movie_name = os.path.basename(root)
-            print(f"\nMovie: {movie_name}")
-
-            if _add_new_trailers:
-                found_movie_trailer = False
-                for trailers_ind, path in enumerate(new_trailers_paths):
-                    if movie_name.lower() in path.lower():
-                        found_movie_trailer = new_trailers_paths.pop(trailers_ind)
-                        print(f"found movie trailer: {found_movie_trailer}")
-                        break
-                if not found_movie_trailer:
-                    continue
-            
-                # backup_nfo(nfo_path)
-                #OR:
-                # nfo_backup_path = nfo_path.replace("movie.nfo", "movie.nfo.backup")
-                # if os.path.exists(nfo_backup_path):
-                #     os.remove(nfo_backup_path)
-                #     print("removed backup-nfo")
-
-                trailers_folder = os.path.join(root, "trailers")
-                os.makedirs(trailers_folder, exist_ok=True)
-                #OR:
-                # if os.path.exists(trailers_folder):
-                #     shutil.rmtree(trailers_folder)
-                #     continue
-
-                path_at_share = os.path.join(root, "trailers", os.path.basename(found_movie_trailer))
-                shutil.copyfile(found_movie_trailer, path_at_share)
-                update_nfo_with_trailers(nfo_path, [path_at_share])
-            
-            if _link_local_trailers:
-                trailers_folder = os.path.join(root, "trailers")
-                if os.path.exists(trailers_folder):
-                    local_trailers = [ os.path.join(trailers_folder, trailer_path) for trailer_path in os.listdir(trailers_folder) ]
-                    update_nfo_with_trailers(nfo_path, local_trailers)
-            
-            if _update_tags_by_filename:
-                movie_files = [ file for file in files if file.rsplit(".", 1)[-1] in {"mp4", "mkv"} ]
-                for movie_file in movie_files:
-                    file_tags = re.findall(r"\[([^\[\]]+)\]", movie_file)
-                    update_nfo_with_tags(nfo_path, set(file_tags), extend_tags=True)
+        # map returns the results in the order of the folders, so the logs are printed in a deterministic order
+        for root, (status, lines, synced_folders) in zip(changed_folders, executor.map(process, changed_folders)):
+            print("\n".join(lines))
+            if status is not None:
+                counts[status] += 1
+            if synced_folders is None:
+                folders[root].pop("synced", None)
+            else:
+                folders.update(synced_folders)
+    
+    if _manifest_path is not None:
+        save_manifest(_manifest_path, {"options": options, "folders": folders})
+    
+    print(f"\n{counts['changed']} NFOs changed, {counts['untouched']} untouched, {counts['failed']} failed")
 
 
 